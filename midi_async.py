@@ -0,0 +1,251 @@
+#
+#     midi_async.py
+#   asyncio playback engine: several songs at once, each to its own output
+#   (a midi_sinks.py sink, or anything with a send_message()), with start,
+#   pause, resume and stop control.
+#   The event loop only does the pacing: each stream hands its events, a few ms
+#   ahead of their deadline, to the sender thread of its output. That thread
+#   sends them in deadline order, does the precise wait and the blocking
+#   send_message() call, so a slow port never holds up the loop or the other
+#   streams
+#
+#     Usage (plays every song at the same time):
+#   python midi_async.py <portNum>:<.mid filename> [<portNum>:<.mid filename> ...]
+#
+
+import sys
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import midi_parser
+
+LookAhead = 0.020 #seconds before its deadline an event is handed to the sender
+
+def allnotesoff():
+    return [bytes((0xB0 | channel, midi_parser.AllNotesOff, 0)) for channel in range(16)]
+
+# --- Sender thread, one per output ---
+# takes (deadline in ns, bytes to send, list to put the lateness in, stream it
+# comes from) and sends them soonest deadline first, whatever the order they
+# came in: streams sharing an output submit each on their own schedule. It waits
+# for the deadline like the player does, a new sooner message waking it up
+# while it sleeps. A stream can take back what it submitted and isn't sent yet
+class aSender(threading.Thread):
+    def __init__(self, out, spinThreshold=midi_parser.SpinThreshold):
+        threading.Thread.__init__(self, daemon=True)
+        self.out = out
+        self.spinThresholdNs = int(spinThreshold * 1e9)
+        self.pending = [] #heap of (deadline in ns, order, bytes, lateness list, stream)
+        self.order = 0 #keeps messages with the same deadline in the order they came
+        self.lastDeadlineNs = 0 #latest deadline submitted so far
+        self.closed = False
+        self.changed = threading.Condition()
+        self.start()
+
+    def push(self, deadlineNs, msgToSend, latenessNs, stream):
+        with self.changed:
+            if midi_parser.metrics is not None:
+                midi_parser.metrics.observe("queue_depth", len(self.pending))
+            heapq.heappush(self.pending, (deadlineNs, self.order, msgToSend, latenessNs, stream))
+            self.order += 1
+            self.changed.notify()
+
+    def submit(self, deadlineNs, msgToSend, latenessNs=None, stream=None):
+        self.lastDeadlineNs = max(self.lastDeadlineNs, deadlineNs)
+        self.push(deadlineNs, msgToSend, latenessNs, stream)
+
+    # takes the stream's messages not sent yet back out, returns their
+    # (deadline in ns, bytes to send) in deadline order
+    def withdraw(self, stream):
+        with self.changed:
+            taken = sorted(item for item in self.pending if item[4] is stream)
+            self.pending = [item for item in self.pending if item[4] is not stream]
+            heapq.heapify(self.pending)
+        return [(deadlineNs, msgToSend) for deadlineNs, n, msgToSend, latenessNs, owner in taken]
+
+    # a future that gets its result once everything submitted before is sent
+    def drained(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.push(self.lastDeadlineNs, None, lambda: loop.call_soon_threadsafe(future.set_result, None), None)
+        return future
+
+    # stops once everything submitted is sent
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify()
+
+    # the next message due, once it's within the spin threshold of its deadline
+    def nextdue(self):
+        with self.changed:
+            while True:
+                if not self.pending:
+                    if self.closed:
+                        return None
+                    self.changed.wait()
+                    continue
+                remainingNs = self.pending[0][0] - time.perf_counter_ns()
+                if remainingNs <= self.spinThresholdNs:
+                    return heapq.heappop(self.pending)
+                self.changed.wait((remainingNs - self.spinThresholdNs) / 1e9)
+
+    def run(self):
+        while True:
+            item = self.nextdue()
+            if item is None:
+                return
+            deadlineNs, n, msgToSend, latenessNs, stream = item
+            if msgToSend is None: #drained() marker
+                latenessNs()
+                continue
+            midi_parser.waituntil(deadlineNs, self.spinThresholdNs)
+            sendNs = time.perf_counter_ns()
+            if latenessNs is not None:
+                latenessNs.append(sendNs - deadlineNs)
+            self.out.send_message(msgToSend)
+            if midi_parser.metrics is not None and latenessNs is not None:
+                midi_parser.metrics.sent(time.perf_counter_ns() - sendNs, sendNs - deadlineNs, len(msgToSend))
+
+# --- One song playing on one output ---
+# timeline is any iterable of (time in seconds, bytes to send), like
+# midi_parser.songtimeline() or midi_seek's timelines. Given the song's
+# midi_notes.aNoteIndex (and a timeline in the song's own times), pause and
+# stop turn off the notes that are on one by one, not just with all notes off.
+# What was handed to the sender ahead of time is taken back first, so nothing
+# of the song goes out after the silence: resume hands it over again
+class aStream:
+    def __init__(self, timeline, sender, notes=None):
+        self.timeline = timeline
+        self.first = None #first event, taken out of timeline by prepare()
+        self.sender = sender
+        self.notes = notes
+        self.lastTime = 0. #time of the last event handed to the sender
+        self.withdrawn = [] #(deadline in ns, bytes) taken back from the sender on pause
+        self.latenessNs = [] #filled by the sender thread
+        self.paused = False
+        self.stopped = False
+        self.startNs = 0
+        self.pausedAtNs = 0
+        self.changed = None #asyncio.Event, set on pause/resume/stop to wake play() up
+
+    # waits until deadlineNs, or until paused/stopped. Returns whether to go on
+    async def waitfor(self, deadlineNs):
+        while not self.stopped:
+            if self.paused:
+                await self.changed.wait()
+                self.changed.clear()
+                continue
+            remaining = (deadlineNs - time.perf_counter_ns()) / 1e9
+            if remaining <= 0:
+                return True
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+                self.changed.clear()
+            except asyncio.TimeoutError:
+                pass
+        return False
+
+    # getting the first event can take a while (merging, parsing...): it's done
+    # before the clock starts, and before any other stream's clock starts when
+    # they're played together, so it doesn't hold up their events
+    def prepare(self):
+        if self.first is None:
+            self.timeline = iter(self.timeline)
+            self.first = list(itertools.islice(self.timeline, 1))
+
+    async def play(self):
+        self.prepare()
+        self.changed = asyncio.Event()
+        lookAheadNs = int(LookAhead * 1e9)
+        self.startNs = time.perf_counter_ns()
+        for absTime, msgToSend in itertools.chain(self.first, self.timeline):
+            #startNs moves forward on resume, so the deadline is worked out again after waiting
+            if not await self.waitfor(self.startNs + int(absTime * 1e9) - lookAheadNs):
+                break
+            self.sender.submit(self.startNs + int(absTime * 1e9), msgToSend, self.latenessNs, self)
+            self.lastTime = absTime
+        await self.sender.drained()
+        while self.paused and not self.stopped: #what was taken back goes out once resumed
+            await self.waitfor(0)
+            await self.sender.drained()
+        return midi_parser.latencystats(self.latenessNs)
+
+    # takes back what's not sent yet, then turns off what's on at that time
+    def silence(self, nowNs):
+        self.withdrawn = self.sender.withdraw(self)
+        if self.notes is not None:
+            position = min(self.lastTime, (nowNs - self.startNs) / 1e9) #where the song got to on the output
+            for msgToSend in self.notes.noteoffs(position, includeEnding=True):
+                self.sender.submit(0, msgToSend)
+        for msgToSend in allnotesoff():
+            self.sender.submit(0, msgToSend)
+
+    def pause(self):
+        if self.paused or self.stopped:
+            return
+        self.paused = True
+        self.pausedAtNs = time.perf_counter_ns()
+        self.silence(self.pausedAtNs)
+        self.changed.set()
+
+    def resume(self):
+        if not self.paused:
+            return
+        pausedNs = time.perf_counter_ns() - self.pausedAtNs
+        self.startNs += pausedNs
+        for deadlineNs, msgToSend in self.withdrawn:
+            self.sender.submit(deadlineNs + pausedNs, msgToSend, self.latenessNs, self)
+        self.withdrawn = []
+        self.paused = False
+        self.changed.set()
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.silence(time.perf_counter_ns())
+        self.withdrawn = []
+        self.changed.set()
+
+# --- Engine: one sender per output, any number of streams ---
+class aEngine:
+    def __init__(self, spinThreshold=midi_parser.SpinThreshold):
+        self.spinThreshold = spinThreshold
+        self.senders = {} #id of the output -> its aSender
+
+    def stream(self, timeline, out, notes=None):
+        if id(out) not in self.senders:
+            self.senders[id(out)] = aSender(out, self.spinThreshold)
+        return aStream(timeline, self.senders[id(out)], notes)
+
+    # plays every stream to the end, returns their lateness stats in the same order
+    async def playall(self, streams):
+        for stream in streams:
+            stream.prepare()
+        return await asyncio.gather(*[stream.play() for stream in streams])
+
+    def close(self):
+        for sender in self.senders.values():
+            sender.close()
+
+if __name__ == "__main__":
+    import midi_cache
+    import midi_sinks
+    midi_parser.setuplogging()
+    engine = aEngine()
+    outs = {}
+    streams = []
+    for arg in sys.argv[1:]:
+        portNum, file = arg.split(":", 1)
+        if portNum not in outs:
+            outs[portNum] = midi_sinks.opensink(portNum)
+        streams.append(engine.stream(midi_parser.songtimeline(midi_cache.loadsong(file)), outs[portNum]))
+    for stats in asyncio.run(engine.playall(streams)):
+        print("lateness over %d events (ms): first=%.3f max=%.3f p50=%.3f p99=%.3f total drift=%.3f" %
+              (stats["events"], stats["first"], stats["max"], stats["p50"], stats["p99"], stats["drift"]))
+    engine.close()
+    for out in outs.values():
+        out.close()
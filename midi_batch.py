@@ -0,0 +1,89 @@
+#
+#     midi_batch.py
+#   Headless analysis of a whole folder of .mid files: every file is parsed in
+#   a pool of processes (one per core by default) and summed up in one row:
+#   format, number of tracks, ppq, event counts, duration, tempo changes and
+#   the parse error if there was one. Nothing gets played, no MIDI port is opened.
+#   Rows are written as JSON lines or CSV, to stdout or to a file
+#
+#     Usage:
+#   python midi_batch.py <folder or glob> [-o rows.csv|rows.json] [-j workers]
+#
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+import concurrent.futures
+import midi_parser
+
+Columns = ["file", "format", "tracks", "ppq", "events", "noteOns", "noteOffs", "aftertouch", "controlChanges",
+           "programChanges", "channelPressure", "pitchBends", "duration", "tempoChanges", "error"]
+
+# status nibble -> column counting it
+StatusColumns = {0x80: "noteOffs", 0x90: "noteOns", 0xA0: "aftertouch", 0xB0: "controlChanges",
+                 0xC0: "programChanges", 0xD0: "channelPressure", 0xE0: "pitchBends"}
+
+def midifiles(target):
+    if os.path.isdir(target):
+        found = glob.glob(os.path.join(target, "*.mid")) + glob.glob(os.path.join(target, "*.MID"))
+    else:
+        found = glob.glob(target)
+    return sorted(set(found))
+
+# runs in a worker process: parse one file and sum it up
+def analyze(file):
+    row = dict.fromkeys(Columns)
+    row["file"] = file
+    try:
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(file))
+        events = mySong.events
+        row["format"] = mySong.formatType
+        row["tracks"] = events.trackcount()
+        row["ppq"] = mySong.ppq
+        row["events"] = len(events)
+        counts = dict.fromkeys(StatusColumns.values(), 0)
+        for status in events.status:
+            counts[StatusColumns[status & 0xF0]] += 1
+        row.update(counts)
+        lastTick = max(events.ticks) if len(events) > 0 else 0
+        row["duration"] = round(mySong.tempoMap.tick2seconds(lastTick), 3)
+        row["tempoChanges"] = len(mySong.tempoMap.tempoChanges)
+    except Exception as e:
+        row["error"] = "%s: %s" % (type(e).__name__, e)
+    return row
+
+def writerows(rows, output, asCsv):
+    if asCsv:
+        writer = csv.DictWriter(output, fieldnames=Columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            output.write(json.dumps(row) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse a folder of .mid files in parallel and sum each one up")
+    parser.add_argument("target", help="folder holding .mid files, or a glob pattern")
+    parser.add_argument("-o", "--output", help="file to write, CSV if it ends in .csv, JSON lines otherwise (default: stdout)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of processes (default: one per core)")
+    parser.add_argument("--csv", action="store_true", help="write CSV to stdout instead of JSON lines")
+    args = parser.parse_args()
+
+    files = midifiles(args.target)
+    startNs = time.perf_counter_ns()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        #chunks keep the per-file overhead down on big libraries, map() keeps the order
+        rows = list(pool.map(analyze, files, chunksize=max(1, len(files) // (4 * args.workers))))
+    elapsed = (time.perf_counter_ns() - startNs) / 1e9
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            writerows(rows, output, args.output.lower().endswith(".csv"))
+    else:
+        writerows(rows, sys.stdout, args.csv)
+    errors = len([row for row in rows if row["error"]])
+    print("%d files, %d errors, %d workers, %.3f s" % (len(rows), errors, args.workers, elapsed), file=sys.stderr)
@@ -0,0 +1,139 @@
+#
+#     midi_bench.py
+#   Benchmarks the three stages of midi_parser.py on .mid files, by default the
+#   ones bundled in this folder:
+#   - load:     read_until_mthd()
+#   - parse:    parse()
+#   - schedule: the merged timeline going through the player's loop, sent to a
+#               null output with every deadline already due, so nothing sleeps
+#   Each stage is run a few times and the best time is kept, then run once more
+#   under tracemalloc for the memory it keeps and its peak.
+#   Results can be saved as a JSON baseline; when a baseline exists, every run
+#   is compared to it and stages that got slower or bigger than the tolerance
+#   are flagged (and the exit code is 1)
+#
+#     Usage:
+#   python midi_bench.py [files or folders] [-r repetitions] [-b baseline.json] [--save] [-t tolerance]
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tracemalloc
+import midi_sinks
+import midi_parser
+
+Stages = ("load", "parse", "schedule")
+
+def midifiles(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += glob.glob(os.path.join(path, "*.mid")) + glob.glob(os.path.join(path, "*.MID"))
+        else:
+            found.append(path)
+    return sorted(set(found))
+
+# the song's timeline with every event due right away: what's left is the cost
+# of merging, building messages and the clock checks, not the waiting
+def duetimeline(mySong):
+    for absTime, msgToSend in midi_parser.songtimeline(mySong):
+        yield 0., msgToSend
+
+def runstage(stage, file, buf, mySong):
+    if stage == "load":
+        return midi_parser.read_until_mthd(file)
+    elif stage == "parse":
+        return midi_parser.parse(buf)
+    else:
+        return midi_parser.playtimeline(duetimeline(mySong))
+
+# best time in seconds, then memory kept and peak in bytes
+def measure(stage, file, buf, mySong, repetitions):
+    bestTime = None
+    for rep in range(repetitions):
+        startNs = time.perf_counter_ns()
+        runstage(stage, file, buf, mySong)
+        elapsed = (time.perf_counter_ns() - startNs) / 1e9
+        if bestTime is None or elapsed < bestTime:
+            bestTime = elapsed
+    tracemalloc.start()
+    result = runstage(stage, file, buf, mySong)
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return bestTime, kept, peak
+
+def benchfile(file, repetitions):
+    results = {}
+    buf = midi_parser.read_until_mthd(file)
+    mySong = midi_parser.parse(buf)
+    nbEvents = len(mySong.events)
+    for stage in Stages:
+        elapsed, kept, peak = measure(stage, file, buf, mySong, repetitions)
+        results[stage] = {"seconds": elapsed, "eventsPerSecond": nbEvents / elapsed if elapsed > 0 else 0.,
+                          "keptBytes": kept, "peakBytes": peak}
+    return {"bytes": len(buf), "events": nbEvents, "stages": results}
+
+# a stage regressed if it got slower, or its peak memory bigger, by more than tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for stage in Stages:
+            now = results[name]["stages"][stage]
+            before = baseline[name]["stages"].get(stage)
+            if before is None:
+                continue
+            if now["seconds"] > before["seconds"] * (1 + tolerance):
+                regressions.append("%s %s: %.3f ms -> %.3f ms" % (name, stage, before["seconds"] * 1e3, now["seconds"] * 1e3))
+            if now["peakBytes"] > before["peakBytes"] * (1 + tolerance):
+                regressions.append("%s %s: peak %d -> %d bytes" % (name, stage, before["peakBytes"], now["peakBytes"]))
+    return regressions
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark loading, parsing and scheduling of .mid files")
+    parser.add_argument("paths", nargs="*", default=[here], help=".mid files or folders (default: the bundled ones)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per stage, the best one is kept (default: 5)")
+    parser.add_argument("-b", "--baseline", default=os.path.join(here, "bench_baseline.json"), help="JSON baseline to compare to")
+    parser.add_argument("--save", action="store_true", help="save this run as the new baseline")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.10, help="slowdown allowed before flagging a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    midi_parser.out = midi_sinks.aNullSink()
+    results = {}
+    print("%-32s %8s %-9s %10s %12s %10s %10s" % ("file", "events", "stage", "ms", "events/s", "kept KB", "peak KB"))
+    for file in midifiles(args.paths):
+        name = os.path.basename(file)
+        results[name] = benchfile(file, args.repeat)
+        for stage in Stages:
+            r = results[name]["stages"][stage]
+            print("%-32s %8d %-9s %10.3f %12.0f %10.1f %10.1f" % (name[:32], results[name]["events"], stage, r["seconds"] * 1e3,
+                                                                  r["eventsPerSecond"], r["keptBytes"] / 1024, r["peakBytes"] / 1024))
+    print("-------------")
+    for stage in Stages:
+        totalTime = sum([results[name]["stages"][stage]["seconds"] for name in results])
+        totalEvents = sum([results[name]["events"] for name in results])
+        totalBytes = sum([results[name]["bytes"] for name in results])
+        if totalTime > 0:
+            print("%-9s total %10.3f ms %12.0f events/s %8.2f MB/s" % (stage, totalTime * 1e3, totalEvents / totalTime, totalBytes / totalTime / 1e6))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as ff:
+            baseline = json.load(ff)
+        regressions = compare(results, baseline["files"], args.tolerance)
+        print("-------------")
+        print("compared to ", args.baseline, ": ", len(regressions), " regression(s)")
+        for regression in regressions:
+            print("  REGRESSION ", regression)
+    if args.save:
+        with open(args.baseline, "w") as ff:
+            json.dump({"python": sys.version, "repeat": args.repeat, "files": results}, ff, indent=1)
+        print("baseline saved to ", args.baseline)
+    sys.exit(1 if regressions else 0)
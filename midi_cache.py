@@ -0,0 +1,177 @@
+#
+#     midi_cache.py
+#   Keeps parsed songs around so a .mid file that was played before doesn't
+#   get parsed again. Two layers:
+#   - in this process, the last few songs loaded, keyed by path, size and mtime
+#   - on disk, one compact binary file per song, keyed by a hash of the .mid
+#     file contents and of the parser version, read back through mmap.
+#     The folder is kept under a size limit by deleting the least recently
+#     used songs first
+#
+#     Usage (warms up the cache and compares a cold parse to a cache hit):
+#   python midi_cache.py <.mid filename> [<.mid filename> ...]
+#
+
+import os
+import sys
+import mmap
+import time
+import array
+import struct
+import hashlib
+import logging
+import collections
+import midi_parser
+
+log = logging.getLogger("midi_cache")
+
+CacheDir = os.environ.get("MIDI_PARSER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "midi_parser"))
+CacheMaxBytes = 64 * 1024 * 1024 #the on-disk cache never grows past this
+MemoEntries = 16 #number of songs kept in this process
+
+CacheMagic = b"MPC1"
+# magic, parser version, format type, ppq, smpte tick length, number of events,
+# of tracks and of tempo changes
+CacheHeader = struct.Struct("<4sHHHdIII")
+# the columns, in the order they're written, then the tempo changes
+EventColumns = ("ticks", "tracks", "status", "data1", "data2")
+
+memo = collections.OrderedDict()
+
+# --- Cache key: what's in the file, and which parser read it ---
+# arrays are written in native byte order, so that goes in the key as well
+def songkey(data):
+    hasher = hashlib.sha256()
+    hasher.update(b"%d %s " % (midi_parser.ParserVersion, sys.byteorder.encode()))
+    hasher.update(data)
+    return hasher.hexdigest()
+
+# --- Writing a song out ---
+def savesong(mySong, path):
+    events = mySong.events
+    tempoMap = mySong.tempoMap
+    tempoTicks = array.array('I', [change[0] for change in tempoMap.tempoChanges])
+    tempoValues = array.array('I', [change[1] for change in tempoMap.tempoChanges])
+    tmpPath = path + ".tmp%d" % os.getpid()
+    with open(tmpPath, "wb") as ff:
+        ff.write(CacheHeader.pack(CacheMagic, midi_parser.ParserVersion, mySong.formatType, mySong.ppq,
+                                  tempoMap.smpteTickLength, len(events), events.trackcount(), len(tempoTicks)))
+        events.trackStarts.tofile(ff)
+        for column in EventColumns:
+            getattr(events, column).tofile(ff)
+        tempoTicks.tofile(ff)
+        tempoValues.tofile(ff)
+    os.replace(tmpPath, path) #readers never see a half written song
+
+# --- Reading a song back ---
+# returns None if the file isn't a song we can trust
+def readcolumn(view, offset, typecode, count):
+    column = array.array(typecode)
+    end = offset + count * column.itemsize
+    column.frombytes(view[offset:end])
+    return column, end
+
+def loadcached(path):
+    with open(path, "rb") as ff:
+        with mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                if len(view) < CacheHeader.size:
+                    return None
+                magic, version, formatType, ppq, smpteTickLength, nbEvents, nbTracks, nbTempo = CacheHeader.unpack_from(view)
+                if magic != CacheMagic or version != midi_parser.ParserVersion:
+                    return None
+                events = midi_parser.aMIDIEventTable()
+                offset = CacheHeader.size
+                events.trackStarts, offset = readcolumn(view, offset, 'I', nbTracks)
+                for column in EventColumns:
+                    values, offset = readcolumn(view, offset, getattr(events, column).typecode, nbEvents)
+                    setattr(events, column, values)
+                tempoTicks, offset = readcolumn(view, offset, 'I', nbTempo)
+                tempoValues, offset = readcolumn(view, offset, 'I', nbTempo)
+                if offset != len(view):
+                    return None
+            finally:
+                view.release()
+    tempoMap = midi_parser.aTempoMap(ppq, list(zip(tempoTicks, tempoValues)), smpteTickLength)
+    return midi_parser.aMIDISong(events, tempoMap, formatType, ppq)
+
+# --- Size bounded LRU eviction ---
+# a cache hit touches its file, so the oldest mtime is the least recently used
+def evict(cacheDir, maxBytes):
+    entries = []
+    totalBytes = 0
+    for name in os.listdir(cacheDir):
+        if not name.endswith(".mpc"):
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+        totalBytes += stat.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if totalBytes <= maxBytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        totalBytes -= size
+
+# --- Loading a song, parsing it only if it isn't cached ---
+def memokey(file):
+    stat = os.stat(file)
+    return (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+
+def cachepath(file, cacheDir):
+    with open(file, "rb") as ff:
+        data = ff.read()
+    return os.path.join(cacheDir, songkey(data) + ".mpc")
+
+# whether loadsong() would skip parsing
+def iscached(file, cacheDir=CacheDir):
+    return memokey(file) in memo or os.path.exists(cachepath(file, cacheDir))
+
+def loadsong(file, cacheDir=CacheDir, maxBytes=CacheMaxBytes):
+    memoKey = memokey(file)
+    if memoKey in memo:
+        memo.move_to_end(memoKey)
+        return memo[memoKey]
+
+    path = cachepath(file, cacheDir)
+    mySong = None
+    if os.path.exists(path):
+        try:
+            mySong = loadcached(path)
+            os.utime(path)
+        except (OSError, ValueError, struct.error):
+            mySong = None
+    if mySong is None:
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(file))
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            savesong(mySong, path)
+            evict(cacheDir, maxBytes)
+        except OSError as e:
+            log.warning("Could not cache the song: %s", e)
+
+    memo[memoKey] = mySong
+    if len(memo) > MemoEntries:
+        memo.popitem(last=False)
+    return mySong
+
+if __name__ == "__main__":
+    for file in sys.argv[1:]:
+        startNs = time.perf_counter_ns()
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(file))
+        coldNs = time.perf_counter_ns() - startNs
+        loadsong(file)
+        memo.clear() #time the disk layer, not the memo
+        startNs = time.perf_counter_ns()
+        loadsong(file)
+        warmNs = time.perf_counter_ns() - startNs
+        print("-------------")
+        print(file, ": ", len(mySong.events), " events, cold parse ", coldNs / 1e6, " ms, cache hit ", warmNs / 1e6, " ms")
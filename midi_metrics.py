@@ -0,0 +1,150 @@
+#
+#     midi_metrics.py
+#   Runtime metrics of the parser and the player, to find out where a stutter
+#   comes from: loading the file, parsing it, picking the next event (merge,
+#   tempo map, building the message) or a send_message() that blocks.
+#   midi_parser.py (and midi_async.py) look at midi_parser.metrics at each of
+#   those points and do nothing else while it's None, so there's no cost when
+#   it's off. Once enable()d, it gathers:
+#   - time and events of every load and parse, and of the playing itself, for
+#     events per second
+#   - histograms of the time taken to pick each event, of each send_message()
+#     and of how late each event went out, and of the senders' queue depth
+#   and writes them as JSON, or as a Prometheus text file (.prom)
+#
+#     Usage (plays the song, then writes the metrics):
+#   python midi_parser.py <portNum> <.mid filename> --metrics <.json or .prom file>
+#
+
+import json
+import bisect
+import threading
+import midi_parser
+
+# upper bounds of the buckets, in ns for the timings
+TimeBuckets = (1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000,
+               1000000, 2000000, 5000000, 10000000, 20000000, 50000000, 100000000)
+DepthBuckets = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+Histograms = {"select": TimeBuckets, "send": TimeBuckets, "lateness": TimeBuckets, "queue_depth": DepthBuckets}
+Help = {"select": "time taken to pick the next event to play",
+        "send": "time spent in send_message()",
+        "lateness": "how late each event was sent compared to its deadline",
+        "queue_depth": "messages waiting in a sender's queue when one more is added"}
+
+class aHistogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) #the last one is everything above the bounds
+        self.sum = 0
+        self.count = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # upper bound of the bucket the q quantile falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for k in range(len(self.bounds)):
+            seen += self.counts[k]
+            if seen >= rank:
+                return self.bounds[k]
+        return self.max
+
+class aMetrics:
+    def __init__(self):
+        self.lock = threading.Lock() #senders of midi_async report from their own threads
+        self.stages = {} #"load", "parse", "play" -> [runs, ns, events]
+        self.histograms = {name: aHistogram(bounds) for name, bounds in Histograms.items()}
+        self.eventsSent = 0
+        self.bytesSent = 0
+
+    def stage(self, name, elapsedNs, events=0):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += elapsedNs
+            totals[2] += events
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    # one event out: how long send_message() took, how late it was and, from
+    # the player, how long it took to pick
+    def sent(self, sendNs, latenessNs, nbBytes, selectNs=None):
+        with self.lock:
+            if selectNs is not None:
+                self.histograms["select"].observe(selectNs)
+            self.histograms["send"].observe(sendNs)
+            self.histograms["lateness"].observe(latenessNs)
+            self.eventsSent += 1
+            self.bytesSent += nbBytes
+
+    def snapshot(self):
+        with self.lock:
+            stages = {}
+            for name, (runs, elapsedNs, events) in self.stages.items():
+                stages[name] = {"runs": runs, "seconds": elapsedNs / 1e9, "events": events,
+                                "eventsPerSecond": events / (elapsedNs / 1e9) if elapsedNs > 0 else 0.}
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = {"unit": "ns" if histogram.bounds is TimeBuckets else "messages", "count": histogram.count, "sum": histogram.sum, "max": histogram.max,
+                                    "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99),
+                                    "buckets": dict(zip([str(bound) for bound in histogram.bounds] + ["+Inf"], histogram.counts))}
+            return {"eventsSent": self.eventsSent, "bytesSent": self.bytesSent, "stages": stages, "histograms": histograms}
+
+    def tojson(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    # Prometheus text exposition format: timings in seconds, buckets cumulative
+    def toprometheus(self):
+        lines = ["# HELP midi_events_sent_total messages sent to the output",
+                 "# TYPE midi_events_sent_total counter",
+                 "midi_events_sent_total %d" % self.eventsSent,
+                 "# HELP midi_bytes_sent_total bytes sent to the output",
+                 "# TYPE midi_bytes_sent_total counter",
+                 "midi_bytes_sent_total %d" % self.bytesSent,
+                 "# HELP midi_stage_seconds_total time spent in each stage",
+                 "# TYPE midi_stage_seconds_total counter"]
+        with self.lock:
+            stages = dict(self.stages)
+            for name in stages:
+                lines.append('midi_stage_seconds_total{stage="%s"} %.9f' % (name, stages[name][1] / 1e9))
+            lines += ["# HELP midi_stage_events_total events gone through each stage",
+                      "# TYPE midi_stage_events_total counter"]
+            for name in stages:
+                lines.append('midi_stage_events_total{stage="%s"} %d' % (name, stages[name][2]))
+            for name, histogram in self.histograms.items():
+                timing = histogram.bounds is TimeBuckets
+                metric = "midi_%s_seconds" % name if timing else "midi_%s" % name
+                scale = 1e-9 if timing else 1
+                lines += ["# HELP %s %s" % (metric, Help[name]), "# TYPE %s histogram" % metric]
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%g"} %d' % (metric, bound * scale, cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+                lines.append("%s_sum %g" % (metric, histogram.sum * scale))
+                lines.append("%s_count %d" % (metric, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    # .prom files get the Prometheus format, anything else JSON
+    def dump(self, path):
+        with open(path, "w") as ff:
+            ff.write(self.toprometheus() if path.endswith(".prom") else self.tojson())
+
+# turns the hooks on, returns what they fill
+def enable():
+    midi_parser.metrics = aMetrics()
+    return midi_parser.metrics
+
+def disable():
+    midi_parser.metrics = None
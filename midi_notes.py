@@ -0,0 +1,162 @@
+#
+#     midi_notes.py
+#   Every note of a parsed song as an interval: the time of its note on to the
+#   time of its note off (note ons with a velocity of 0 are note offs already,
+#   parse() sees to it). A note off ends the oldest note still on for its
+#   channel and note number, and a note never turned off lasts until the end.
+#   Built once, then:
+#   - notes sounding at a time: a centered interval tree, O(log n + k)
+#   - notes sounding anywhere in a window: the same, plus a bisect on the starts
+#   - the most notes each channel has on at once, and when
+#   - note offs for just the notes that are on, to stop or seek without
+#     leaving any hanging, even on synths that ignore all notes off
+#
+#     Usage (prints the polyphony of every channel, and what sounds at a time):
+#   python midi_notes.py <.mid filename> [time in s]
+#
+
+import sys
+import array
+import bisect
+import midi_parser
+
+class aNoteIndex:
+    # events is the song's aMIDIEventTable, order its rows in merged time order
+    # and times the time in seconds of each, like aSeekIndex has them
+    def __init__(self, events, order, times):
+        self.starts = array.array('d')   #note on time, notes are sorted on it
+        self.ends = array.array('d')     #note off time
+        self.channels = array.array('B')
+        self.notes = array.array('B')
+        self.velocities = array.array('B')
+        self.peaks = [0] * 16           #most notes on at once, per channel
+        self.peakTimes = [0.] * 16      #first time it happened
+
+        openNotes = {} #(channel, note) -> ids of the notes still on, oldest first
+        for n in range(len(order)):
+            row = order[n]
+            status = events.status[row]
+            kind = status & 0xF0
+            if kind != 0x90 and kind != 0x80:
+                continue
+            key = (status & 0x0F, events.data1[row])
+            if kind == 0x90:
+                openNotes.setdefault(key, []).append(len(self.starts))
+                self.starts.append(times[n])
+                self.ends.append(-1.)
+                self.channels.append(key[0])
+                self.notes.append(key[1])
+                self.velocities.append(events.data2[row])
+            elif openNotes.get(key):
+                self.ends[openNotes[key].pop(0)] = times[n]
+        songEnd = times[-1] if len(times) > 0 else 0.
+        for ids in openNotes.values():
+            for noteId in ids:
+                self.ends[noteId] = songEnd
+
+        self.findpeaks()
+        self.nodeCenters = [] #the tree, one entry per node in each list
+        self.nodeByStart = [] #ids of the notes holding the center, by start
+        self.nodeByEnd = []   #and by end, latest first
+        self.nodeLeft = []    #child nodes, -1 for none
+        self.nodeRight = []
+        #notes that end where they start never sound, they're left out of the tree
+        self.root = self.buildtree([noteId for noteId in range(len(self.starts)) if self.ends[noteId] > self.starts[noteId]])
+
+    def __len__(self):
+        return len(self.starts)
+
+    # a sweep over every note on and off, offs first on the same time
+    def findpeaks(self):
+        changes = sorted([(self.starts[noteId], 1, self.channels[noteId]) for noteId in range(len(self.starts))] +
+                         [(self.ends[noteId], -1, self.channels[noteId]) for noteId in range(len(self.starts))])
+        current = [0] * 16
+        for changeTime, change, channel in changes:
+            current[channel] += change
+            if current[channel] > self.peaks[channel]:
+                self.peaks[channel] = current[channel]
+                self.peakTimes[channel] = changeTime
+
+    # ids are sorted by start. The center is the start of the middle one: notes
+    # over it stay in the node, the ones before it go left and after it right
+    def buildtree(self, ids):
+        if not ids:
+            return -1
+        center = self.starts[ids[len(ids) // 2]]
+        here, left, right = [], [], []
+        for noteId in ids:
+            if self.ends[noteId] <= center:
+                left.append(noteId)
+            elif self.starts[noteId] > center:
+                right.append(noteId)
+            else:
+                here.append(noteId)
+        node = len(self.nodeCenters)
+        self.nodeCenters.append(center)
+        self.nodeByStart.append(array.array('I', here))
+        self.nodeByEnd.append(array.array('I', sorted(here, key=lambda noteId: self.ends[noteId], reverse=True)))
+        self.nodeLeft.append(-1)
+        self.nodeRight.append(-1)
+        self.nodeLeft[node] = self.buildtree(left)
+        self.nodeRight[node] = self.buildtree(right)
+        return node
+
+    # ids of the notes on at that time: on at or before it, off after it.
+    # With includeEnding, notes that go off right at that time count too: what a
+    # timeline cut just before its events at that time leaves on
+    def activenotes(self, seconds, includeEnding=False):
+        found = []
+        node = self.root
+        while node >= 0:
+            center = self.nodeCenters[node]
+            if seconds <= center:
+                for noteId in self.nodeByStart[node]: #every one of them ends after the center
+                    if self.starts[noteId] > seconds:
+                        break
+                    found.append(noteId)
+                if seconds == center and not includeEnding:
+                    break
+                node = self.nodeLeft[node]
+            else:
+                for noteId in self.nodeByEnd[node]: #every one of them starts before the center
+                    if self.ends[noteId] < seconds or (self.ends[noteId] == seconds and not includeEnding):
+                        break
+                    found.append(noteId)
+                node = self.nodeRight[node]
+        return found
+
+    # ids of the notes sounding anywhere from start to end (end excluded). Like
+    # activenotes(), notes that end where they start don't count: they never sound
+    def notesbetween(self, start, end):
+        found = self.activenotes(start)
+        first = bisect.bisect_right(self.starts, start)
+        last = bisect.bisect_left(self.starts, end, first)
+        return found + [noteId for noteId in range(first, last) if self.ends[noteId] > self.starts[noteId]]
+
+    def polyphony(self, channel):
+        return self.peaks[channel], self.peakTimes[channel]
+
+    # what to send to turn off the notes on at that time, and only them
+    def noteoffs(self, seconds, includeEnding=False):
+        return [bytes((0x80 | self.channels[noteId], self.notes[noteId], 0)) for noteId in self.activenotes(seconds, includeEnding)]
+
+# the note index of a song on its own, when there's no aSeekIndex to take the merge from
+def songnotes(mySong):
+    order = array.array('I')
+    times = array.array('d')
+    for absTick, trackNo, row, absTime in midi_parser.mergetracks(mySong.events, mySong.tempoMap):
+        order.append(row)
+        times.append(absTime)
+    return aNoteIndex(mySong.events, order, times)
+
+if __name__ == "__main__":
+    mySong = midi_parser.parse(midi_parser.read_until_mthd(sys.argv[1]))
+    index = songnotes(mySong)
+    print(sys.argv[1], ": ", len(index), " notes")
+    for channel in range(16):
+        peak, peakTime = index.polyphony(channel)
+        if peak > 0:
+            print("channel %2d: up to %2d notes at once, first at %.3f s" % (channel + 1, peak, peakTime))
+    if len(sys.argv) > 2:
+        seconds = float(sys.argv[2])
+        print("on at ", seconds, " s: ", ["%d:%d" % (index.channels[noteId] + 1, index.notes[noteId]) for noteId in index.activenotes(seconds)])
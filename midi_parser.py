@@ -26,13 +26,30 @@
 #   a list of available ports will be printed out upon executing
 #
 #     Usage:
-#   python midi_parser.py <portNum> <.mid filename>
+#   python midi_parser.py <portNum> <.mid filename> [spin threshold in ms] [--sleep] [--thin [rate]] [-v | -q] [--metrics file]
+#   instead of a port number: null, loopback, record or record=<file> (see midi_sinks.py)
+#   Imported, it only defines the parser and the player, and prints nothing:
+#   diagnostics go through the logging module, to the "midi_parser" logger
 #
 
 import time
-import rtmidi
+import heapq
+import bisect
+import array
+import mmap
+import threading
 import sys
-from sys import argv
+import logging
+import argparse
+
+# diagnostics: headers, tracks and text events at DEBUG, anything odd in the
+# file at WARNING. Nothing is shown unless the program using the parser sets
+# logging up (main() does), and disabled levels cost a single check
+log = logging.getLogger("midi_parser")
+
+# a midi_metrics.aMetrics when the profiling hooks are on (midi_metrics.enable()),
+# None otherwise: then each hook is a single check
+metrics = None
 
 # --- MIDI spec hard coded values ---
 # good reference is here: https://www.music.mcgill.ca/~ich/classes/mumt306/StandardMIDIfileformat.html#BM1_1
@@ -47,6 +64,8 @@ MetaInstrumentName = 0x04
 MetaLyrics         = 0x05
 MetaMarker         = 0x06
 MetaCuePoint       = 0x07
+MetaProgramName    = 0x08
+MetaDeviceName     = 0x09
 MetaChannelPrefix  = 0x20
 MetaChangePort     = 0x21
 MetaEndOfTrack     = 0x2F
@@ -56,431 +75,612 @@ MetaTimeSignature  = 0x58
 MetaKeySignature   = 0x59
 MetaSequencerSpecific = 0x7F
 
+# bump whenever what parse() produces changes: it invalidates songs cached by midi_cache.py
+ParserVersion = 1
+
 class aMIDIEvent:
-    deltaToGo = 0
-    msgToSend = None 
-   
-# --- detect the no of tracks, length of each track, to see if .mid chunks make sense
-def detectstructure(buffer):
-    bpm = 0 #beat per minute
-    ppq = 0 #ppq read from header
-    tick = 0 #millisecond per tick
-    
-    trackcount = 0 #number of tracks detected
-    i = 0 #main array parsing index
-            
-    print("MIDI file header")
-    print("-------------")
-    hdrTag = buffer[i:(i+4)]
-    i+=4
-    print(hdrTag)
-    size = buffer[i:(i+4)]
-    print("size ",int.from_bytes(size))
+    __slots__ = ("tick", "track", "msgToSend")
+    def __init__(self, tick=0, track=0, msgToSend=None):
+        self.tick = tick #absolute position in ticks from the start of its track
+        self.track = track
+        self.msgToSend = msgToSend
+
+# the bytes to send out for a channel message. Program change and channel
+# pressure (0xC_, 0xD_) have a single data byte
+def channelmessage(status, data1, data2):
+    if 0xC0 <= status <= 0xDF:
+        return bytes((status, data1))
+    return bytes((status, data1, data2))
+
+# what a channel message sets, and to what: sending the same value again is a
+# no-op. (None, None) for messages that aren't plain state: notes, polyphonic
+# pressure (it belongs to a note), channel mode messages (controllers 120 and
+# up), data entry/(N)RPN controllers, where repeating a value still counts,
+# and program changes: the same program again is what applies a bank select
+NonStateControllers = (6, 38, 96, 97, 98, 99, 100, 101)
+ResetAllControllers = 121
+AllNotesOff = 123
+
+def statekey(status, data1, data2):
+    kind = status & 0xF0
+    if kind == 0xB0:
+        if data1 < 120 and data1 not in NonStateControllers:
+            return (status, data1), data2
+    elif kind == 0xD0:
+        return (status,), data1
+    elif kind == 0xE0:
+        return (status,), (data2 << 7) | data1
+    return None, None
+
+# a reset all controllers puts the channel's controllers, pressure and pitch
+# bend back to defaults: the values noted for it before can't be relied on
+def forgetchannel(channelState, status):
+    channel = status & 0x0F
+    for key in [key for key in channelState if (key[0] & 0x0F) == channel]:
+        del channelState[key]
+
+# --- Columnar event store ---
+# instead of one object (plus its bytearray) per message, every parsed event is
+# a row across parallel arrays: absolute tick, track, status, data1 and data2.
+# Around 9 bytes per event and nothing for the garbage collector to walk.
+# Rows are stored track after track, each track in time order, and
+# trackStarts tells where each track begins. Iterating gives aMIDIEvent
+# records built on the fly, for code that wants to walk events one by one
+class aMIDIEventTable:
+    def __init__(self):
+        self.ticks = array.array('I')  #absolute tick from the start of the track
+        self.tracks = array.array('H') #track number the event belongs to
+        self.status = array.array('B')
+        self.data1 = array.array('B')
+        self.data2 = array.array('B')  #0 for messages with a single data byte
+        self.trackStarts = array.array('I') #index of the first event of each track
+
+    def starttrack(self):
+        self.trackStarts.append(len(self.ticks))
+
+    def append(self, tick, track, status, data1, data2=0):
+        self.ticks.append(tick)
+        self.tracks.append(track)
+        self.status.append(status)
+        self.data1.append(data1)
+        self.data2.append(data2)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def trackcount(self):
+        return len(self.trackStarts)
+
+    def trackrange(self, trackNo):
+        start = self.trackStarts[trackNo]
+        end = self.trackStarts[trackNo+1] if trackNo+1 < len(self.trackStarts) else len(self.ticks)
+        return start, end
+
+    # the bytes to send out for event n
+    def message(self, n):
+        return channelmessage(self.status[n], self.data1[n], self.data2[n])
+
+    def event(self, n):
+        return aMIDIEvent(self.ticks[n], self.tracks[n], self.message(n))
+
+    def __iter__(self):
+        for n in range(len(self.ticks)):
+            yield self.event(n)
+
+# --- Global tempo map ---
+# every MetaSetTempo of every track (in format 1 files they live in the tempo
+# track) gathered into segments of constant tempo. Each segment knows the tick
+# it starts at, its length of a tick in seconds and the time it starts at, so
+# converting a tick to seconds is a bisect on the segment starts, O(log n).
+# Until the first tempo event the spec default of 120 bpm applies.
+# For SMPTE time division a tick has a fixed length and tempo events are ignored.
+DefaultTempo = 500000 #microseconds per quarter note, 120 bpm
+
+class aTempoMap:
+    def __init__(self, ppq, tempoChanges, smpteTickLength=0.):
+        self.ppq = ppq
+        self.smpteTickLength = smpteTickLength
+        self.tempoChanges = sorted(tempoChanges, key=lambda change: change[0]) #(tick, microseconds per beat)
+        self.segmentTicks = [0]   #tick at which each segment starts
+        self.segmentTimes = [0.]  #time in seconds at which each segment starts
+        if smpteTickLength > 0:
+            self.segmentTickLengths = [smpteTickLength]
+            return
+        self.segmentTickLengths = [DefaultTempo / (1e6 * ppq)] #length of a tick in seconds
+        for changeTick, usPerBeat in self.tempoChanges:
+            tickLength = usPerBeat / (1e6 * ppq)
+            if changeTick == self.segmentTicks[-1]: #a later change on the same tick wins
+                self.segmentTickLengths[-1] = tickLength
+                continue
+            self.segmentTimes.append(self.tick2seconds(changeTick))
+            self.segmentTicks.append(changeTick)
+            self.segmentTickLengths.append(tickLength)
+
+    def tick2seconds(self, tick):
+        k = bisect.bisect_right(self.segmentTicks, tick) - 1
+        return self.segmentTimes[k] + (tick - self.segmentTicks[k]) * self.segmentTickLengths[k]
+
+    # convert a whole track at once. Ticks of a track only go forward, so we walk
+    # the segments alongside instead of doing one bisect per event
+    def ticks2seconds(self, ticks):
+        seconds = array.array('d', bytes(8 * len(ticks)))
+        if len(ticks) == 0:
+            return seconds
+        k = bisect.bisect_right(self.segmentTicks, ticks[0]) - 1
+        nextSegmentTick = self.segmentTicks[k+1] if k+1 < len(self.segmentTicks) else None
+        for n in range(len(ticks)):
+            tick = ticks[n]
+            if nextSegmentTick is not None and tick >= nextSegmentTick:
+                k = bisect.bisect_right(self.segmentTicks, tick, k) - 1
+                nextSegmentTick = self.segmentTicks[k+1] if k+1 < len(self.segmentTicks) else None
+            elif tick < self.segmentTicks[k]: #not sorted after all, fall back on a bisect
+                k = bisect.bisect_right(self.segmentTicks, tick) - 1
+                nextSegmentTick = self.segmentTicks[k+1] if k+1 < len(self.segmentTicks) else None
+            seconds[n] = self.segmentTimes[k] + (tick - self.segmentTicks[k]) * self.segmentTickLengths[k]
+        return seconds
+
+# --- A parsed song: its tracks of events along with how to time them ---
+class aMIDISong:
+    def __init__(self, events, tempoMap, formatType=0, ppq=0):
+        self.events = events     #aMIDIEventTable holding every track
+        self.tempoMap = tempoMap #aTempoMap to turn ticks into seconds
+        self.formatType = formatType
+        self.ppq = ppq
    
-    i+=4
-    print("format type ",int.from_bytes(buffer[i:(i+2)]))
-    i+=2
-    trackcount = int.from_bytes(buffer[i:(i+2)])
-    i+=2
-    print("number of tracks ",trackcount)
-    
-    tdiv = buffer[i:(i+2)]
-    i+=2
-    
-    if (tdiv[0] & 0x80) == 0x00:
-        print("time division is ticks per beat, ticks=",int.from_bytes(tdiv))
-        ppq = int.from_bytes(tdiv)
-    elif (tdiv[0] & 0x80) == 0x80:
-        print("time division is frames per s= ",int.from_bytes(tdiv[1])) 
-        
-    totalLen = len(buffer)
-    print("total len=",totalLen)
-    current_track=0
-    while i < totalLen:
-        print("i=",i)
-        current_track+=1
-        track_hdr = buffer[i:(i+4)]
-        i+=4
-        print("-------------")
-        print("Track header for track #", current_track," ",track_hdr)
-        print("-------------")
-        tracklength = int.from_bytes(buffer[i:(i+4)])
-        i+=4
-        print("length: ",tracklength)
-        print("-------------")
-        i+=tracklength
-    
 # --- Opening a port to MIDI out ---
 # using the rtmidi package to fetch and open a MIDI out port.
 # note: you may need to use another port number than mine depending on your system
 # I expect Windows' typical port 0 is the GS Synth driver that's used to approximate midi sounds, 
 # used by Windows Media Player when playing .mid files
+
+# --- Loading a .mid file ---
+# the file is memory-mapped and what's handed to the parser is a memoryview
+# starting at MThd: nothing is copied, whatever comes before the header.
+# RIFF RMID files (.rmi, sometimes named .mid) wrap the standard midi file in
+# their "data" chunk, which is then used as is
+def findrmiddata(view):
+    i = 12 #after "RIFF", the size and "RMID"
+    while i + 8 <= len(view):
+        chunkId = bytes(view[i:(i+4)])
+        chunkSize = int.from_bytes(view[(i+4):(i+8)], "little")
+        i+=8
+        if chunkId == b"data":
+            return i, min(i + chunkSize, len(view))
+        i+=chunkSize + (chunkSize & 1) #chunks are padded to an even size
+    return -1, -1
+
 def read_until_mthd(file):
-    i=0 #index
-    buffer = b"" # Initialize an empty buffer to store the encountered bytes
+    startNs = time.perf_counter_ns() if metrics is not None else 0
+    log.debug("MIDI file name: %s", file)
     try:
         with open(file, 'rb') as ff:
-            raw_data = bytearray(ff.read())
-            ff.seek(0)
-            data_buffer_len = len(bytearray(ff.read()))
-            ff.seek(0)
-            
-            print("MIDI file name: ",file)
-            print("-------------")
-            # Define the target sequence of bytes: MThd
-            target_bytes = b"MThd"
-            # Iterate through the input byte data
-            for byte in raw_data:
-                # Append the current byte to the buffer
-                buffer += bytes([byte])
-                i+=1
-                # Check if the buffer contains the target sequence
-                if buffer.endswith(target_bytes):
-                    # Found the target sequence, break the loop
-                    break
+            mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) #stays valid once the file is closed
     except FileNotFoundError:
-        print(f"File '{filename}' not found.")
-    except Exception as e:
-        print(f"Error reading the file: {e}")
-    return raw_data[(i-4):]
+        log.error("File '%s' not found.", file)
+        raise
+    except (OSError, ValueError) as e: #an empty file can't be mapped
+        log.error("Error reading the file: %s", e)
+        raise
+    view = memoryview(mm)
+    start, end = 0, len(mm)
+    if mm[0:4] == b"RIFF" and mm[8:12] == b"RMID":
+        start, end = findrmiddata(view)
+        log.debug("RIFF RMID file, midi data at i=%d", start)
+    if start >= 0:
+        start = mm.find(b"MThd", start, end)
+    if start < 0:
+        log.error("No MThd header found in '%s'.", file)
+        raise ValueError(f"no MThd header in '{file}'")
+    if metrics is not None:
+        metrics.stage("load", time.perf_counter_ns() - startNs)
+    return view[start:end]
     
   
     
+# --- Variable length quantities ---
+# delta times and meta/SysEx lengths are stored 7 bits per byte, most significant
+# first, with the MSB set on every byte but the last one.
+# Returns the value along with the index right after it
+def readvlq(buffer, i):
+    value = 0
+    byte = buffer[i]
+    i+=1
+    while byte & 0x80:
+        value = (value << 7) | (byte & 0x7F)
+        byte = buffer[i]
+        i+=1
+    return (value << 7) | byte, i
+
 # --- Parsing a midi file specified by the 1st argument upon execution
+# the buffer is indexed directly through a memoryview: every byte read is an int
+# and no intermediate bytes object gets created for it
+MetaTextEvents = (MetaText, MetaCopyright, MetaTrackName, MetaInstrumentName, MetaLyrics, MetaMarker, MetaCuePoint)
 
-def parse(buffer):
-    bpm = 0 #beat per minute
+# header chunk: returns format type, number of tracks, ppq, tick length for
+# SMPTE time division (0 otherwise) and the index of the first chunk after it
+def readheader(buffer):
     ppq = 0 #ppq read from header
-    tick = 0 #millisecond per tick
-    myParsedEventList = [] #init the big list of all parsed events being prepped
+    smpteTickLength = 0. #length of a tick in seconds, only for SMPTE time division
+    if len(buffer) < 14:
+        log.error("MThd header cut short: %d bytes", len(buffer))
+        raise ValueError("MThd header cut short")
+    size = int.from_bytes(buffer[4:8])
+    formatType = int.from_bytes(buffer[8:10])
+    trackcount = int.from_bytes(buffer[10:12])
+    log.debug("MIDI file header: size %d, format type %d, number of tracks %d", size, formatType, trackcount)
     
-    
-    trackcount = 0 #number of tracks detected
+    if (buffer[12] & 0x80) == 0x00:
+        ppq = int.from_bytes(buffer[12:14])
+        log.debug("time division is ticks per beat, ticks=%d", ppq)
+    else:
+        fps = 256 - buffer[12] #negative frames per second in two's complement
+        log.debug("time division is frames per s=%d ticks per frame=%d", fps, buffer[13])
+        smpteTickLength = 1./(fps*buffer[13])
+    return formatType, trackcount, ppq, smpteTickLength, 8 + size #the header can be longer than the 6 bytes we know about
+
+# hops from chunk to chunk and gives (track number, start, end) of each track
+def trackchunks(buffer, i, trackcount):
     current_track = 0 #number of tracks that have been read so fa
-    i = 0 #main array parsing index
-            
-    print("MIDI file header")
-    print("-------------")
-    hdrTag = buffer[i:(i+4)]
-    i+=4
-    print(hdrTag)
-    size = buffer[i:(i+4)]
-    print("size ",int.from_bytes(size))
-   
-    i+=4
-    print("format type ",int.from_bytes(buffer[i:(i+2)]))
-    i+=2
-    trackcount = int.from_bytes(buffer[i:(i+2)])
-    i+=2
-    print("number of tracks ",trackcount)
-    
-    
-    
-    tdiv = buffer[i:(i+2)]
-    i+=2
-    
-    if (tdiv[0] & 0x80) == 0x00:
-        print("time division is ticks per beat, ticks=",int.from_bytes(tdiv))
-        ppq = int.from_bytes(tdiv)
-    elif (tdiv[0] & 0x80) == 0x80:
-        print("time division is frames per s= ",int.from_bytes(tdiv[1])) 
-    
-    current_track = 0
-    tracklength = 1 #value of 1 by default, will get changed once a track header is read
-    cementedStartI = i
     totalLen = len(buffer)
-    while i < totalLen: # main loop, parse every remaining tracks
-        print("i=",i)
+    while i + 8 <= totalLen and current_track < trackcount: # main loop, parse every remaining tracks
+        track_hdr = bytes(buffer[i:(i+4)])
+        tracklength = int.from_bytes(buffer[(i+4):(i+8)])
+        i+=8
+        if track_hdr != b"MTrk": #unknown chunks are allowed and must be skipped
+            log.debug("skipping chunk %s length: %d", track_hdr, tracklength)
+            i+=tracklength
+            continue
+        trackEnd = min(i + tracklength, totalLen)
+        log.debug("track #%d %s: length %d, from i=%d to i=%d", current_track+1, track_hdr, tracklength, i, trackEnd)
+        yield current_track, i, trackEnd
         current_track+=1
-        if(current_track>trackcount):
-            break
-        #now that we're sure a track has to happen, instanciate the track of elements item
-        aTOE = [] #init the list of events being worked on
-        
-        
-        track_hdr = buffer[i:(i+4)]
-        i+=4
-        print("-------------")
-        print("Track header for track #", current_track," ",track_hdr)
-        print("-------------")
-        tracklength = int.from_bytes(buffer[i:(i+4)])
-        i+=4
-        print("length: ",tracklength)
-        print("-------------")
-    
-        last_cmd = 0x00
-        currentI = i #check the current location from which to delimit the track reading
-        print("current index i=",i," will finish track at i=",tracklength+currentI)
-        while i < (tracklength + currentI):
-           
-            nValue = 0
-            nValue2 = 0
-            nValue3 = 0
-            nValue4 = 0
+        i = trackEnd
+
+# one track, lazily: yields (absolute tick, status, data1, data2) for every
+# channel message, data2 being 0 when there's a single data byte. Tempo changes
+# come out as (absolute tick, 0xFF, MetaSetTempo, microseconds per beat).
+# Everything else is skipped over. Nothing is read past trackEnd: an event cut
+# short (a truncated file, a wrong length) ends the track with a warning
+def trackevents(buffer, i, trackEnd):
+    buffer = buffer[:trackEnd] #reading past it raises IndexError instead of going into the next chunk
+    last_cmd = 0x00 #running status, only channel messages set it
+    absTick = 0 #absolute position in ticks from the start of this track
+    debug = log.isEnabledFor(logging.DEBUG) #checked once, not on every text event
+    try:
+        while i < trackEnd:
+            timeDelta, i = readvlq(buffer, i)
+            absTick += timeDelta
         
-            status_byte = 0 #status byte for reading MIDI commands
-            dataCombo = [] #data byte(s) read 
+            #status byte / MIDI message reading
+            status_byte = buffer[i]
+            if status_byte < 0x80: #run-on command that doesn't repeat the status_byte
+                status_byte = last_cmd
+            else:
+                i+=1
             
-            recognizedCmdForPlayback = 0 #set to 1 if it must be put in the player
-            forWhichChannel = 0x00
+            #MIDI commands with 2 data bytes
+            # Note off   0x8_
+            # Note on    0x9_
+            # Polyphonic Key Pressure  0xA_ (Aftertouch)
+            # Control Change           0xB_
+            # Pitch Bend               0xE_
+            if (0x80 <= status_byte <= 0xBF) or (0xE0 <= status_byte <= 0xEF):
+                last_cmd = status_byte
+                data1 = buffer[i]
+                data2 = buffer[i+1]
+                i+=2
+                if (status_byte & 0xF0) == 0x90 and data2 == 0:
+                    yield absTick, status_byte & 0x8F, data1, data2 #note on with velocity 0 is a note off
+                else:
+                    yield absTick, status_byte, data1, data2
             
-            #time delta reading. Assume it's at most 4 bytes (7 bits each, 
-            #total max of 28 sign. bits with 4 extra padded 0's
-            nValue = int.from_bytes(buffer[i:(i+1)])
-            i+=1
-            if nValue & 0x0080:
-                nValue &= 0x007F # toss out the MSB
-                nValue <<= 7     # shift it 7 positions to make room for the next 7bits
-                nValue2 = int.from_bytes(buffer[i:(i+1)])
+            #MIDI commands with only 1 data byte
+            # Program change   0xC_
+            # Channel Pressure 0xD_
+            elif 0xC0 <= status_byte <= 0xDF:
+                last_cmd = status_byte
                 i+=1
-                if nValue2 & 0x0080:
-                    nValue2 &= 0x007F # toss out the MSB
-                    nValue2 <<= 7     # shift it 7 positions to make room for the next 7bits
-                    nValue <<= 7      # shift it 7 positions to make room for the next 7bits
-                    nValue3 = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    if nValue3 & 0x0080:
-                        nValue3 &= 0x007F # toss out the MSB
-                        nValue3 <<= 7     # shift it 7 positions to make room for the next 7bits
-                        nValue2 <<= 7     # shift it 7 positions to make room for the next 7bits
-                        nValue <<= 7      # shift it 7 positions to make room for the next 7bits
-                        nValue4 = int.from_bytes(buffer[i:(i+1)])
-                        i+=1
-            timeDelta = nValue | nValue2 | nValue3 | nValue4
+                yield absTick, status_byte, buffer[i-1], 0
             
+            #meta-events: type, VLQ length, then that many bytes of payload
+            elif status_byte == 0xFF:
+                last_cmd = 0x00 #meta events cancel running status
+                meta_byte = buffer[i]
+                metaLen, i = readvlq(buffer, i+1)
+                if i + metaLen > trackEnd:
+                    raise IndexError("meta event payload cut short")
+                if meta_byte == MetaEndOfTrack:
+                    if debug:
+                        log.debug("end of track at tick %d", absTick)
+                    return
+                elif meta_byte == MetaSetTempo:
+                    yield absTick, 0xFF, MetaSetTempo, int.from_bytes(buffer[i:(i+3)])
+                elif meta_byte in MetaTextEvents:
+                    if debug:
+                        log.debug("  %s", bytes(buffer[i:(i+metaLen)]))
+                elif meta_byte not in (MetaSequence, MetaProgramName, MetaDeviceName, MetaChannelPrefix, MetaChangePort, MetaSMPTEOffset,
+                                       MetaTimeSignature, MetaKeySignature, MetaSequencerSpecific):
+                    log.warning("Unrecognised MetaEvent: sb=%d mb=%d", status_byte, meta_byte)
+                i+=metaLen #skip the payload, whatever it was
             
-            #status byte / MIDI message reading
-            status_byte = int.from_bytes(buffer[i:(i+1)])
-            i+=1 
+            #SysEx, either complete (0xF0) or a continuation/escape (0xF7): skipped by length
+            elif status_byte == 0xF0 or status_byte == 0xF7:
+                last_cmd = 0x00
+                sysexLen, i = readvlq(buffer, i)
+                i+=sysexLen
             
-            #First, check for run-on commands that don't repeat the status_byte
-            if (status_byte < 0x80):
-                status_byte = last_cmd
-                i-=1 #go back 1 spot so it can read the data properly
-                
-            #Second, deal with MIDI meta-event commands that start with 0xFF.
-            if (status_byte & 0xFF) == 0xFF:
-                meta_byte = int.from_bytes(buffer[i:(i+1)])
-                i+=1
-                if meta_byte == MetaSequence:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=buffer[i:(i+1)]
-                    i+=1
-                    notemsg = [status_byte, meta_byte, data1, data2] 
-                elif meta_byte == MetaText:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)                        
-                elif meta_byte == MetaCopyright:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  
-                elif meta_byte == MetaTrackName:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  	
-                elif meta_byte == MetaInstrumentName:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  	
-                elif meta_byte == MetaLyrics:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  	
-                elif meta_byte == MetaMarker:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  	
-                elif meta_byte == MetaCuePoint:
-                    tLen = int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    text = buffer[i:(i+tLen)]
-                    i+=tLen
-                    print("  ",text)  	
-                elif meta_byte == MetaChannelPrefix:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=buffer[i:(i+1)]
-                    i+=1	
-                elif meta_byte == MetaChangePort:
-                    i+=2
-                elif meta_byte == MetaEndOfTrack:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    print("--------------------------------------------------- END OF TRACK")
-                    #append the track of events to the global list
-                    myParsedEventList.append(aTOE)
-                    break
-                elif meta_byte == MetaSetTempo:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    data3=int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    data4=int.from_bytes(buffer[i:(i+1)])
-                    i+=1
-                    bpm = 6e7/(data2<<16 | data3 <<8 | data4)
-                    tick = 60./(bpm*ppq)
-                elif meta_byte == MetaSMPTEOffset:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=buffer[i:(i+1)]
-                    i+=1
-                    data3=buffer[i:(i+1)]
-                    i+=1
-                    data4=buffer[i:(i+1)]
-                    i+=1
-                    data5=buffer[i:(i+1)]
-                    i+=1
-                    data6=buffer[i:(i+1)]
-                    i+=1
-                elif meta_byte == MetaTimeSignature:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=buffer[i:(i+1)]
-                    i+=1
-                    data3=buffer[i:(i+1)]
-                    i+=1
-                    data4=buffer[i:(i+1)]
-                    i+=1
-                    data5=buffer[i:(i+1)]
-                    i+=1	
-                elif meta_byte == MetaKeySignature:
-                    data1=buffer[i:(i+1)]
-                    i+=1
-                    data2=buffer[i:(i+1)]
-                    i+=1
-                    data3=buffer[i:(i+1)]
-                    i+=1
-                elif meta_byte == MetaSequencerSpecific:
-                    continue	
-                else:
-                    print("Unrecognised MetaEvent: sb=",status_byte," mb=",meta_byte)
-                    
-    #Third, deal with regular MIDI commands
+            else:
+                log.warning("unrecognized event sb=%d at i=%d, rest of the track skipped", status_byte, i)
+                return #no way to know how long it is, give up on this track
+    except IndexError:
+        log.warning("track cut short at i=%d, rest of the track skipped", trackEnd)
+
+def parse(buffer):
+    startNs = time.perf_counter_ns() if metrics is not None else 0
+    tempoChanges = [] #(absolute tick, microseconds per beat) gathered from every track
+    myParsedEvents = aMIDIEventTable() #init the table of all parsed events being prepped
+    appendTick = myParsedEvents.ticks.append #bound once, these get called for every event
+    appendTrack = myParsedEvents.tracks.append
+    appendStatus = myParsedEvents.status.append
+    appendData1 = myParsedEvents.data1.append
+    appendData2 = myParsedEvents.data2.append
     
-    #MIDI commands with only 1 data byte
-    # Program change   0xC_
-    # Channel Pressure 0xD_
-            elif 0xC0 <= status_byte <= 0xDF:
-                dataCombo.append(buffer[i:(i+1)])
-                i+=1
-                recognizedCmdForPlayback=1
-                forWhichChannel = status_byte & 0x0F
-                
-                         
-    #MIDI commands with 2 data bytes
-    # Note off   0x8_
-    # Note on    0x9_
-    # Polyphonic Key Pressure  0xA_ (Aftertouch)
-    # Control Change           0xB_
-    # (0xC_ and 0xD_ have been taken care of earlier already)
-    # Pitch Bend               0xE_
-            elif (0x80 <= status_byte <= 0xBF) or (0xE0 <= status_byte <= 0xEF):
+    buffer = memoryview(buffer)
+    formatType, trackcount, ppq, smpteTickLength, i = readheader(buffer)
+    for trackNo, start, trackEnd in trackchunks(buffer, i, trackcount):
+        myParsedEvents.starttrack()
+        for absTick, status_byte, data1, data2 in trackevents(buffer, start, trackEnd):
+            if status_byte == 0xFF:
+                tempoChanges.append((absTick, data2))
+                continue
+            appendTick(absTick)
+            appendTrack(trackNo)
+            appendStatus(status_byte)
+            appendData1(data1)
+            appendData2(data2)
                 
-   
-                dataCombo.append(buffer[i:(i+1)])
-                i+=1
-                dataCombo.append(buffer[i:(i+1)])
-                i+=1
+    if metrics is not None:
+        metrics.stage("parse", time.perf_counter_ns() - startNs, len(myParsedEvents))
+    return aMIDISong(myParsedEvents, aTempoMap(ppq, tempoChanges, smpteTickLength), formatType, ppq)        
 
-                if (0x90 <= status_byte <= 0x9F) and dataCombo[1] == 0: 
-                    status_byte&=0x8F #note on with velocity 0 is a note off
-                    
-                recognizedCmdForPlayback=1
-                forWhichChannel = status_byte & 0x0F
-                
-            else:
-                print("------unrecognized event sb=", status_byte)
-            last_cmd = status_byte
-        
-            if(recognizedCmdForPlayback):
-                finalMsg = bytearray([status_byte])
-                for item in dataCombo:
-                    finalMsg.extend(item)
-                
-                newEvent = aMIDIEvent()
-                newEvent.deltaToGo = tick*timeDelta
-                newEvent.msgToSend = finalMsg
-                aTOE.append(newEvent)
-                
-    return myParsedEventList        
-
-def playback(myTOE):
-    numberTracks = len(myTOE)
-    eventsLeftPerTrack = [] #contains the number of pending events
-    pendingEvents = [] #contains the queued up next events to play per track
-    print("number of tracks: ",numberTracks)
-    for i in range(len(myTOE)):
-        nbEvents = len(myTOE[i])
-        eventsLeftPerTrack.append(nbEvents) #put number of event in pending count
-        if(nbEvents>0):
-            pendingEvents.append(myTOE[i][0]) #slot in the first event if there's one
+# --- Merge every track into a single timeline ---
+# each track is already sorted in time, so the next event to play is always
+# the smallest head among the tracks. A heap keyed on the absolute tick of each
+# head (k-way merge) finds it in O(log tracks) instead of scanning every track.
+# Times in seconds come from the tempo map, a whole track at a time: the parsed
+# events are not modified. eventNo is the row of the event in the table
+def tracktimeline(events, trackNo, tempoMap):
+    start, end = events.trackrange(trackNo)
+    ticks = events.ticks[start:end]
+    absTimes = tempoMap.ticks2seconds(ticks)
+    for n in range(end - start):
+        yield (ticks[n], trackNo, start + n, absTimes[n])
+
+def mergetracks(events, tempoMap):
+    #ties on ticks are broken by track number then event number, like the old scan did
+    return heapq.merge(*[tracktimeline(events, i, tempoMap) for i in range(events.trackcount())])
+
+# (time in seconds, bytes to send) for every event of a parsed song
+def songtimeline(mySong):
+    events = mySong.events
+    for absTick, trackNo, eventNo, absTime in mergetracks(events, mySong.tempoMap):
+        yield absTime, events.message(eventNo)
+
+# --- Streaming: playing while parsing ---
+# every track is a lazy trackevents() generator and the heap merges their heads
+# straight into the player. The first note goes out once the first event of
+# each track has been read, and only one pending event per track is held in
+# memory, however long the song is.
+# Merged in tick order, a tempo change always comes out before the events that
+# follow it, so time is tracked on the fly from the last tempo change seen
+def streamtrack(buffer, trackNo, start, trackEnd):
+    n = 0 #breaks ties on ticks within a track, keeps the file's order
+    for absTick, status, data1, data2 in trackevents(buffer, start, trackEnd):
+        yield absTick, trackNo, n, status, data1, data2
+        n+=1
+
+def streamtimeline(buffer):
+    buffer = memoryview(buffer)
+    formatType, trackcount, ppq, smpteTickLength, i = readheader(buffer)
+    tracks = [streamtrack(buffer, trackNo, start, trackEnd) for trackNo, start, trackEnd in trackchunks(buffer, i, trackcount)]
+    segmentTick = 0 #tick of the last tempo change
+    segmentTime = 0. #and its time in seconds
+    tickLength = aTempoMap(ppq, [], smpteTickLength).segmentTickLengths[0] #before any tempo change
+    for absTick, trackNo, n, status, data1, data2 in heapq.merge(*tracks):
+        absTime = segmentTime + (absTick - segmentTick) * tickLength
+        if status == 0xFF:
+            if smpteTickLength == 0: #SMPTE ticks have a fixed length
+                segmentTick, segmentTime, tickLength = absTick, absTime, data2 / (1e6 * ppq)
+            continue
+        yield absTime, channelmessage(status, data1, data2)
+
+# --- Playback clock ---
+# "deadline" mode schedules every event against an absolute deadline measured
+# from the start of the song with time.perf_counter_ns(), so sleep overshoot and
+# send_message cost never pile up. Waiting is hybrid: sleep until we're within
+# spinThreshold seconds of the deadline, then busy-wait the rest. A bigger
+# threshold is more accurate but burns more CPU; 0 means sleep only.
+# "sleep" mode is the old behaviour, a relative time.sleep() between events.
+SpinThreshold = 0.002 #seconds
+
+def waituntil(deadlineNs, spinThresholdNs):
+    remainingNs = deadlineNs - time.perf_counter_ns()
+    if remainingNs > spinThresholdNs:
+        time.sleep((remainingNs - spinThresholdNs) / 1e9)
+    while time.perf_counter_ns() < deadlineNs:
+        pass
+
+# --- Live tempo ---
+# a multiplier on the playing speed that can be changed from another thread while
+# a timeline plays (2.0 is twice as fast). Nothing already parsed or merged is
+# touched: the clock keeps an anchor, the last time the multiplier changed both
+# on the perf_counter and in song time, and every deadline is worked out from
+# it as the event comes up. A change wakes the player up if it was sleeping
+class aTempoControl:
+    def __init__(self, multiplier=1.0):
+        self.anchor = (0, 0., multiplier) #(ns, song time in seconds, multiplier), swapped as a whole
+        self.changed = threading.Event()
+
+    def start(self, startNs):
+        self.anchor = (startNs, 0., self.anchor[2])
+
+    def multiplier(self):
+        return self.anchor[2]
+
+    def songtime(self, nowNs):
+        anchorNs, anchorTime, multiplier = self.anchor
+        return anchorTime + (nowNs - anchorNs) / 1e9 * multiplier
+
+    def set(self, multiplier):
+        if multiplier <= 0:
+            raise ValueError("tempo multiplier must be positive, not %g" % multiplier)
+        nowNs = time.perf_counter_ns()
+        self.anchor = (nowNs, self.songtime(nowNs), multiplier)
+        self.changed.set()
+
+    def deadline(self, absTime):
+        anchorNs, anchorTime, multiplier = self.anchor
+        return anchorNs + int((absTime - anchorTime) / multiplier * 1e9)
+
+    # like waituntil(), but the deadline moves if the multiplier changes meanwhile
+    def waitfor(self, absTime, spinThresholdNs):
+        while True:
+            deadlineNs = self.deadline(absTime)
+            remainingNs = deadlineNs - time.perf_counter_ns()
+            if remainingNs <= spinThresholdNs:
+                break
+            if self.changed.wait((remainingNs - spinThresholdNs) / 1e9):
+                self.changed.clear()
+        waituntil(deadlineNs, spinThresholdNs)
+        return deadlineNs
+
+# lateness of every event sent (ns after its ideal time), summed up in ms
+def latencystats(latenessNs):
+    if len(latenessNs) == 0:
+        return {"events": 0, "first": 0.0, "max": 0.0, "p50": 0.0, "p99": 0.0, "drift": 0.0}
+    ordered = sorted(latenessNs)
+    count = len(ordered)
+    return {"events": count,
+            "first": latenessNs[0] / 1e6, #time to the first note
+            "max": ordered[-1] / 1e6,
+            "p50": ordered[(count - 1) * 50 // 100] / 1e6,
+            "p99": ordered[(count - 1) * 99 // 100] / 1e6,
+            "drift": latenessNs[-1] / 1e6} #how late the song ends
+
+# plays (time in seconds, bytes to send) pairs as they come. The clock starts
+# before the first one is asked for, so the lateness of the first event is the
+# time it took to get the first note out. With an aTempoControl, the speed can
+# be changed while it plays. Messages go to sink (see midi_sinks.py), by
+# default to the module's out, which has to be set then
+def playtimeline(timeline, clockMode="deadline", spinThreshold=SpinThreshold, tempo=None, sink=None):
+    if sink is None:
+        sink = out
+    if sink is None:
+        raise ValueError("nowhere to play to: give a sink, or set midi_parser.out (see midi_sinks.py)")
+    spinThresholdNs = int(spinThreshold * 1e9)
+    latenessNs = [] #how late each event was sent compared to its ideal time
+    currentTime = 0.0 #absolute time of the last event that was sent
+    startNs = time.perf_counter_ns()
+    if tempo is not None:
+        tempo.start(startNs)
+    sentNs = startNs #when the last event went out, for the time it took to pick the next one
+    #main loop to exhaust all events, in merged time order
+    for absTime, msgToSend in timeline:
+        if metrics is not None:
+            selectNs = time.perf_counter_ns() - sentNs
+        if tempo is not None:
+            deadlineNs = tempo.waitfor(absTime, spinThresholdNs)
+        elif clockMode == "deadline":
+            deadlineNs = startNs + int(absTime * 1e9)
+            waituntil(deadlineNs, spinThresholdNs)
         else:
-            #prep a dummy event to have at least something
-            dummyEvent = aMIDIEvent()
-            pendingEvents.append(dummyEvent)
-    print("eventsLeftPerTrack = ",eventsLeftPerTrack)
-    
-    #main loop to exhaust all events
-    while(sum(eventsLeftPerTrack)>0):
-    
-    #find the list which has an event with the lowest timeDelta
-        lowestIndex = 0 #assume track 0 is the next event to play
-        lowestTimeFound = sys.maxsize #assume lowest is the worst possible
-        for i in range(len(eventsLeftPerTrack)):
-            if eventsLeftPerTrack[i] == 0:
-                continue #skip the loop if one track has been exhausted
-            anEvent = pendingEvents[i]
-            if anEvent.deltaToGo < lowestTimeFound:
-                lowestIndex = i #found it at track i
-                lowestTimeFound = anEvent.deltaToGo #keep track of this for later so we can reduce every other pending deltas by this amount
-            
-    #perform the event
-        if(pendingEvents[lowestIndex].deltaToGo > 0): #only deal with delay if there's a delay
-            time.sleep(pendingEvents[lowestIndex].deltaToGo)
-        
-        out.send_message(pendingEvents[lowestIndex].msgToSend)
-    #slot in the next event
-        eventsLeftPerTrack[lowestIndex]-=1 #reduce # of pending events for that track by 1 since we consumed one event there
-        totalEvents = len(myTOE[lowestIndex])
-        doneEvents = eventsLeftPerTrack[lowestIndex]
-        nextEventIndex =  totalEvents-doneEvents
-        
-        if(eventsLeftPerTrack[lowestIndex] > 0):
-            pendingEvents[lowestIndex]=myTOE[lowestIndex][nextEventIndex] #slots in the correct next event
-        
-    #lower every other pending event's time delta with the one we just did
-        for i in range(len(pendingEvents)):
-            if pendingEvents[i] == 0:
-                continue #skip the loop if there's nothing to consider
-            if i == lowestIndex:
-                continue #skip if this track was the one being dealt with
-            pendingEvents[i].deltaToGo -= lowestTimeFound #reduce the other events
+            deadlineNs = startNs + int(absTime * 1e9)
+            deltaToGo = absTime - currentTime
+            if(deltaToGo > 0): #only deal with delay if there's a delay
+                time.sleep(deltaToGo)
+            currentTime = absTime
+        latenessNs.append(time.perf_counter_ns() - deadlineNs)
+        if metrics is not None:
+            sendNs = time.perf_counter_ns()
+            sink.send_message(msgToSend)
+            sentNs = time.perf_counter_ns()
+            metrics.sent(sentNs - sendNs, latenessNs[-1], len(msgToSend), selectNs)
+        else:
+            sink.send_message(msgToSend)
+
+    if metrics is not None:
+        metrics.stage("play", time.perf_counter_ns() - startNs, len(latenessNs))
+    stats = latencystats(latenessNs)
+    log.info("lateness over %d events (ms): first=%.3f max=%.3f p50=%.3f p99=%.3f total drift=%.3f",
+             stats["events"], stats["first"], stats["max"], stats["p50"], stats["p99"], stats["drift"])
+    return stats
+
+# the optional pass of midi_thin.py between parsing and playback: thin is its
+# rate in messages per second per channel/controller, None plays everything
+def thinned(timeline, thin):
+    if thin is None:
+        return timeline
+    import midi_thin #only needed when thinning
+    return midi_thin.thintimeline(timeline, thin)
+
+def playback(mySong, clockMode="deadline", spinThreshold=SpinThreshold, tempo=None, sink=None, thin=None):
+    events = mySong.events
+    numberTracks = events.trackcount()
+    log.info("number of tracks: %d", numberTracks)
+    log.debug("eventsLeftPerTrack = %s", [events.trackrange(i)[1] - events.trackrange(i)[0] for i in range(numberTracks)])
+    return playtimeline(thinned(songtimeline(mySong), thin), clockMode, spinThreshold, tempo, sink)
+
+# plays straight from the file's bytes, parsing along the way
+def playstream(buffer, clockMode="deadline", spinThreshold=SpinThreshold, tempo=None, sink=None, thin=None):
+    return playtimeline(thinned(streamtimeline(buffer), thin), clockMode, spinThreshold, tempo, sink)
                     
 # --- Main entry point ---
+# importing this module only defines things: playing happens here, and rtmidi
+# is only imported if a hardware port gets opened
+out = None #where the player sends to when it's not given a sink, see midi_sinks.py
 
-out = rtmidi.MidiOut()
-ports = out.get_ports()
-print(ports)
-print("port chosen: ",argv[1]) #which MIDI port is to be used (0,1,...)
-out.open_port(int(argv[1]))
-buf = read_until_mthd(argv[2]) #open midi file and get to MThd, ignore previous bytes; 2nd arg: .mid file name
+# what the command line tools show: the player's stats by default
+def setuplogging(verbose=False, quiet=False):
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG if verbose else logging.WARNING if quiet else logging.INFO)
+
+def main(args=None):
+    global out, metrics
+    import midi_thin
+    parser = argparse.ArgumentParser(description="Play a .mid file to a MIDI out port")
+    parser.add_argument("port", help="MIDI out port number (0,1,...), or another sink: null, loopback, record, record=<file>")
+    parser.add_argument("file", help=".mid file")
+    parser.add_argument("spin", type=float, nargs="?", default=SpinThreshold * 1000., help="how close to a deadline (ms) the player starts busy-waiting (default: %g)" % (SpinThreshold * 1000.))
+    parser.add_argument("--sleep", action="store_true", help="old clock: a relative sleep between events")
+    parser.add_argument("--thin", type=float, nargs="?", const=midi_thin.ThinRate, metavar="rate", help="drop repeated values and thin controller sweeps to rate messages per second, for slow DIN ports (default rate: %g, see midi_thin.py)" % midi_thin.ThinRate)
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the file's headers, tracks and text events")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only show problems")
+    parser.add_argument("--metrics", help="write load, parse and playing metrics to this file: Prometheus text if it ends in .prom, JSON otherwise")
+    args = parser.parse_args(args)
+    setuplogging(args.verbose, args.quiet)
+    if args.metrics:
+        import midi_metrics
+        metrics = midi_metrics.enable() #on this module too, in case it runs as __main__
+
+    import midi_sinks
+    import midi_cache
+    out = midi_sinks.opensink(args.port)
+    clockMode = "sleep" if args.sleep else "deadline"
+    #a song played before comes out of the cache, parsed. Otherwise it's played
+    #while being parsed, and cached once it's over
+    try:
+        if midi_cache.iscached(args.file):
+            return playback(midi_cache.loadsong(args.file), clockMode, args.spin / 1000., thin=args.thin)
+        stats = playstream(read_until_mthd(args.file), clockMode, args.spin / 1000., thin=args.thin)
+        midi_cache.loadsong(args.file)
+        return stats
+    finally:
+        out.close()
+        if metrics is not None:
+            metrics.dump(args.metrics)
+            log.info("metrics written to %s", args.metrics)
 
-detectstructure(buf)
-myTracksOfEvents = parse(buf)  #parse the song and put it in a structure
-playback(myTracksOfEvents) 
+if __name__ == "__main__":
+    #run as a script this module is __main__: the tools it imports (midi_cache,
+    #midi_metrics...) have to find it as midi_parser, not load a second copy
+    sys.modules["midi_parser"] = sys.modules[__name__]
+    main()
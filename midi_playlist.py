@@ -0,0 +1,170 @@
+#
+#     midi_playlist.py
+#   Plays several .mid files one after the other on the same open port, with no
+#   gap in between. Every song is put on the timeline of the one before, so the
+#   player's clock never stops: the first event of a song is due right when the
+#   last event of the previous one went out (plus the gap asked for, if any).
+#   While a song plays, the next one is loaded and parsed in a worker process
+#   (through midi_cache, so a song played before comes straight from the cache),
+#   which keeps the parsing off the player's core as much as possible. Once it's
+#   loaded, its timeline is primed up to its first event in a quiet moment of
+#   the song playing, so the switch itself has nothing left to do.
+#   For every switch, it prints how long before it was needed the next song was
+#   ready (the prefetch lead, negative if the player had to wait for it) and the
+#   gap between the last note of a song and the first of the next one
+#
+#     Usage:
+#   python midi_playlist.py <portNum> <.mid filename> [<.mid filename> ...] [-g gap in s] [--loop]
+#
+
+import time
+import logging
+import argparse
+import itertools
+import concurrent.futures
+import midi_seek
+import midi_cache
+import midi_parser
+
+# what Reset All Controllers leaves alone (RP-015) set back to what a GM synth
+# starts with: bank 0, volume 100, pan center (and program 0)
+DefaultControllers = {0: 0, 32: 0, 7: 100, 10: 64}
+PrimeSlack = 0.050 #seconds free before the next event for the next song to be primed
+log = logging.getLogger("midi_playlist")
+
+# what to send between two songs so the next one starts like on a synth just
+# switched on: no note left on, controllers reset, default bank, program,
+# volume and pan on every channel
+def resetmessages():
+    state = bytearray([midi_seek.Unset]) * midi_seek.StateSize
+    for controller, value in DefaultControllers.items():
+        state[controller] = value
+    state[midi_seek.StateProgram] = 0
+    return midi_seek.statemessages([state] * 16)
+
+class aPlaylist:
+    def __init__(self, files, gap=0., loop=False):
+        self.files = list(files)
+        self.gap = gap #seconds of silence between two songs
+        self.loop = loop
+        self.startNs = 0 #when the player asked for the first event, its clock start
+        self.pool = None
+        self.queue = None #files still to play
+        self.upcoming = None #future of the song being prefetched
+        self.first = None #(future, song) to start with, loaded before the clock starts
+        self.transitions = [] #(file, prefetch lead in s, scheduled gap in s, actual gap in s)
+
+    def prefetch(self, file):
+        future = self.pool.submit(midi_cache.loadsong, file)
+        future.file = file
+        future.readyNs = None
+        def ready(future):
+            future.readyNs = time.perf_counter_ns()
+        future.add_done_callback(ready)
+        return future
+
+    # the next song that loads, None once there are no more. With wait=False it
+    # doesn't wait for a song still loading: (None, None) with self.upcoming
+    # still set, so a broken file is skipped, and the one after it submitted,
+    # as soon as it's known to be broken
+    def nextsong(self, wait=True):
+        while self.upcoming is not None:
+            current = self.upcoming
+            if not wait and not current.done():
+                break
+            file = next(self.queue, None)
+            self.upcoming = self.prefetch(file) if file is not None else None #parsed while this one plays
+            try:
+                return current, current.result()
+            except Exception as e: #a broken file shouldn't stop the whole playlist
+                log.warning("skipping %s: %s", current.file, e)
+        return None, None
+
+    # waits for the first song, before the player's clock starts
+    def start(self):
+        self.queue = itertools.cycle(self.files) if self.loop else iter(self.files)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        file = next(self.queue, None)
+        self.upcoming = self.prefetch(file) if file is not None else None
+        self.first = self.nextsong()
+
+    # (future, [first event], rest of the timeline) of a loaded song, None for
+    # no song. Merging the tracks up to the first event is the slow part of
+    # starting a song, so it's done ahead, while the song before still plays
+    def prime(self, future, mySong):
+        if mySong is None:
+            return None
+        songTimeline = iter(midi_parser.songtimeline(mySong))
+        return future, list(itertools.islice(songTimeline, 1)), songTimeline
+
+    # one timeline for every song, played by midi_parser.playtimeline() like a
+    # single song. The player asks for the next event right after sending the
+    # previous one, which is when the time of each send gets noted, and when
+    # the next song gets primed once it's loaded
+    def timeline(self):
+        if self.first is None:
+            self.start()
+        song = self.prime(*self.first)
+        offset = 0. #time at which the current song starts on the timeline
+        lastTime = None #time of the last event of the song before
+        lastSentNs = 0
+        self.startNs = time.perf_counter_ns()
+        try:
+            while song is not None:
+                current, first, songTimeline = song
+                song = None #the next one, primed while this one plays
+                songEnd = offset
+                for absTime, msgToSend in first:
+                    if lastTime is not None:
+                        #everything before is out, time to reset what the last song set
+                        for resetToSend in resetmessages():
+                            yield offset + absTime, resetToSend
+                    yield offset + absTime, msgToSend
+                    if lastTime is not None:
+                        self.logtransition(current, offset + absTime, lastTime, lastSentNs)
+                    lastSentNs = time.perf_counter_ns()
+                    songEnd = offset + absTime
+                upNext = next(songTimeline, None)
+                while upNext is not None:
+                    absTime, msgToSend = upNext
+                    yield offset + absTime, msgToSend
+                    lastSentNs = time.perf_counter_ns()
+                    songEnd = offset + absTime
+                    upNext = next(songTimeline, None)
+                    #priming takes a few ms, it's done where it can't make the next event late
+                    if (song is None and upNext is not None and self.upcoming is not None and self.upcoming.done()
+                            and self.startNs + int((offset + upNext[0] - PrimeSlack) * 1e9) > time.perf_counter_ns()):
+                        song = self.prime(*self.nextsong(wait=False))
+                if song is None: #not loaded in time, or nothing after
+                    song = self.prime(*self.nextsong())
+                lastTime = songEnd
+                offset = songEnd + self.gap
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    def logtransition(self, future, firstTime, lastTime, lastSentNs):
+        neededNs = self.startNs + int(firstTime * 1e9)
+        lead = (neededNs - future.readyNs) / 1e9 if future.readyNs is not None else 0.
+        scheduled = firstTime - lastTime
+        actual = (time.perf_counter_ns() - lastSentNs) / 1e9
+        self.transitions.append((future.file, lead, scheduled, actual))
+        log.info("next: %s, ready %.3f s before it was needed, gap %.3f ms (%.3f ms scheduled)", future.file, lead, actual * 1e3, scheduled * 1e3)
+
+def playlist(files, gap=0., loop=False, clockMode="deadline", spinThreshold=midi_parser.SpinThreshold):
+    myPlaylist = aPlaylist(files, gap, loop)
+    myPlaylist.start()
+    return midi_parser.playtimeline(myPlaylist.timeline(), clockMode, spinThreshold)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play .mid files back to back on one port, with no gap between them")
+    parser.add_argument("port", help="MIDI out port number, or a sink: null, record=<file>...")
+    parser.add_argument("files", nargs="+", help=".mid files, in playing order")
+    parser.add_argument("-g", "--gap", type=float, default=0., help="seconds of silence between two songs (default: 0)")
+    parser.add_argument("--loop", action="store_true", help="start over after the last song")
+    args = parser.parse_args()
+
+    import midi_sinks
+    midi_parser.setuplogging()
+    midi_parser.out = midi_sinks.opensink(args.port)
+    playlist(args.files, args.gap, args.loop)
+    midi_parser.out.close()
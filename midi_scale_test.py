@@ -1,21 +1,95 @@
-import time
-import rtmidi
+#
+#     midi_scale_test.py
+#   Latency and throughput probe for a sink (see midi_sinks.py), hardware port
+#   or not. Every message goes through a recording sink that timestamps it
+#   with time.perf_counter_ns() before passing it on, then:
+#   - scale:      a C major scale on channel 5, played by the player's clock:
+#                 how far from its deadline each message went out
+#   - throughput: a burst of messages all due at once: how many per second the
+#                 sink takes, and how long each send_message() blocks
+#   - chords:     notes due at the same time: how spread out they come out
+#
+#     Usage:
+#   python midi_scale_test.py [portNum or sink: null, loopback, record=<file>] [-n burst size] [-c chord size]
+#
 
+import time
+import argparse
+import midi_sinks
+import midi_parser
 
 # Define the MIDI commands for a C-major scale
 notes = [60, 62, 64, 65, 67, 69, 71, 72]  # MIDI note numbers for C4 to B4
+NoteLength = 0.1 #seconds a note is on, then off
+ChordInterval = 0.05 #seconds between two chords
+
+def scaletimeline():
+    for i in range(len(notes)):
+        note_on = bytes([0x94, notes[i], 100]) #0x94 is send a note (0x9_) to channel 5 (0x_4)
+        note_off= bytes([0x84, notes[i], 100]) #0x84 is stop a note (0x8_) to channel 5 (0x_4)
+        yield 2 * i * NoteLength, note_on
+        yield (2 * i + 1) * NoteLength, note_off
+
+def bursttimeline(count):
+    for i in range(count):
+        yield 0., bytes([0x94 if i % 2 == 0 else 0x84, notes[(i // 2) % len(notes)], 100])
+
+def chordtimeline(chords, size):
+    for chord in range(chords):
+        for kind in (0x94, 0x84):
+            for note in notes[:size]:
+                yield (2 * chord + (kind == 0x84)) * ChordInterval, bytes([kind, note, 100])
+
+def summary(name, valuesNs):
+    ordered = sorted(valuesNs)
+    if len(ordered) == 0:
+        return
+    count = len(ordered)
+    print("%-24s p50=%9.1f us  p99=%9.1f us  max=%9.1f us  (%d)" % (name, ordered[(count - 1) * 50 // 100] / 1e3,
+          ordered[(count - 1) * 99 // 100] / 1e3, ordered[-1] / 1e3, count))
+
+# argparse type for a whole number from low to high, or from low up if high is None
+def intbetween(low, high=None):
+    def parse(text):
+        value = int(text)
+        if value < low:
+            raise argparse.ArgumentTypeError("%d is less than %d" % (value, low))
+        if high is not None and value > high:
+            raise argparse.ArgumentTypeError("%d is more than %d" % (value, high))
+        return value
+    return parse
+
+# plays the timeline to a fresh recording sink in front of sink, returns it
+# along with about when the player's clock started
+def probe(sink, timeline):
+    recorder = midi_sinks.aRecordingSink(forward=sink)
+    startNs = time.perf_counter_ns()
+    midi_parser.playtimeline(timeline, sink=recorder)
+    return recorder, startNs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how accurately and how fast messages get to a sink")
+    parser.add_argument("sink", nargs="?", default="1", help="MIDI out port number, or null, loopback, record=<file> (default: port 1)")
+    parser.add_argument("-n", "--burst", type=intbetween(2), default=2000, help="messages in the throughput burst, at least 2 (default: 2000)")
+    parser.add_argument("-c", "--chord", type=intbetween(1, len(notes)), default=4, help="notes per chord, 1 to %d (default: 4)" % len(notes))
+    args = parser.parse_args()
+    sink = midi_sinks.opensink(args.sink)
 
-out = rtmidi.MidiOut()
-ports = out.get_ports()
-print(ports)
+    print("-------------")
+    recorder, startNs = probe(sink, scaletimeline())
+    deadlines = [absTime for absTime, msgToSend in scaletimeline()]
+    summary("scale lateness", [recorder.times[n] - startNs - int(deadlines[n] * 1e9) for n in range(len(recorder))])
+    summary("scale send_message", recorder.sendTimes)
 
-out.open_port(1)
+    recorder, startNs = probe(sink, bursttimeline(args.burst))
+    elapsedNs = recorder.times[-1] - recorder.times[0]
+    if elapsedNs > 0:
+        print("%-24s %.0f messages/s, %.0f bytes/s" % ("burst throughput", (len(recorder) - 1) / (elapsedNs / 1e9), len(recorder.data) / (elapsedNs / 1e9)))
+    summary("burst send_message", recorder.sendTimes)
 
-for note in notes:
-    note_on = [0x94, note, 100] #0x94 is send a note (0x9_) to channel 5 (0x_4)
-    note_off= [0x84, note, 100] #0x84 is stop a note (0x8_) to channel 5 (0x_5)
-    out.send_message(note_on)
-    time.sleep(0.1)
-    out.send_message(note_off)
-    time.sleep(0.1)
-    
\ No newline at end of file
+    chords = 20
+    recorder, startNs = probe(sink, chordtimeline(chords, args.chord))
+    spreads = [recorder.times[(n + 1) * args.chord - 1] - recorder.times[n * args.chord] for n in range(2 * chords)]
+    summary("chord spread", spreads)
+    print("-------------")
+    sink.close()
@@ -0,0 +1,196 @@
+#
+#     midi_seek.py
+#   Seeking and A/B looping in a parsed song without replaying it from tick 0.
+#   The song is merged once into a single timeline, and every SnapshotInterval
+#   seconds the state of each channel (controllers, program, channel pressure,
+#   pitch bend) is snapshotted. Seeking to a time is then a bisect to the last
+#   snapshot before it, plus a chase through the few events between the
+#   snapshot and that time. How long that takes depends on the interval, not on
+#   the length of the song. Every channel gets a Reset All Controllers before
+#   its state, so what was set after the time sought (a sustain pedal held
+#   down, a pitch bend) doesn't stay set
+#
+#     Usage:
+#   python midi_seek.py <portNum> <.mid filename> <start s> [<end s> [loops]]
+#
+
+import sys
+import array
+import bisect
+import midi_notes
+import midi_parser
+
+SnapshotInterval = 2.0 #seconds between two snapshots
+
+# state of one channel in a bytearray: the 128 controllers, then program,
+# channel pressure, pitch bend LSB and MSB, and which of RPN or NRPN was
+# selected last (its MSB controller). 0xFF means never set, or reset since:
+# whatever Reset All Controllers leaves it at
+StateProgram = 128
+StatePressure = 129
+StateBendLSB = 130
+StateBendMSB = 131
+StateSelected = 132
+StateSize = 133
+Unset = 0xFF
+BankSelects = (0, 32) #must go out before the program change they apply to
+RPNSelects = (101, 100)
+NRPNSelects = (99, 98)
+DataEntry = (6, 38) #applies to the parameter selected: must go out after RPNSelects or NRPNSelects
+DataIncrements = (96, 97) #steps the parameter, not a state: never sent again
+ParameterControllers = RPNSelects + NRPNSelects + DataEntry + DataIncrements
+# what Reset All Controllers resets (RP-015): modulation, expression, the
+# pedals and the (N)RPN numbers, along with pitch bend and pressure. Bank,
+# program, volume, pan and the rest stay as they were
+ResetControllers = (1, 11, 64, 65, 66, 67, 98, 99, 100, 101)
+
+# applies a message to the channel states if it changes one, returns whether it did
+def applystate(states, status, data1, data2):
+    kind = status & 0xF0
+    state = states[status & 0x0F]
+    if kind == 0xB0:
+        if data1 == midi_parser.ResetAllControllers:
+            for controller in ResetControllers:
+                state[controller] = Unset
+            state[StatePressure] = Unset
+            state[StateBendLSB] = Unset
+            state[StateBendMSB] = Unset
+            state[StateSelected] = Unset
+        elif data1 < 120: #120 and up are channel mode messages, not state
+            state[data1] = data2
+            if data1 in RPNSelects:
+                state[StateSelected] = RPNSelects[0]
+            elif data1 in NRPNSelects:
+                state[StateSelected] = NRPNSelects[0]
+        else:
+            return False
+    elif kind == 0xC0:
+        state[StateProgram] = data1
+    elif kind == 0xD0:
+        state[StatePressure] = data1
+    elif kind == 0xE0:
+        state[StateBendLSB] = data1
+        state[StateBendMSB] = data2
+    else:
+        return False
+    return True
+
+# what to send so a synth ends up in the given channel states, with no note left
+# on and nothing left from before: controllers get reset, then set again
+def statemessages(states):
+    messages = []
+    for channel in range(16):
+        state = states[channel]
+        messages.append(bytes((0xB0 | channel, midi_parser.AllNotesOff, 0)))
+        messages.append(bytes((0xB0 | channel, midi_parser.ResetAllControllers, 0)))
+        for controller in BankSelects:
+            if state[controller] != Unset:
+                messages.append(bytes((0xB0 | channel, controller, state[controller])))
+        if state[StateProgram] != Unset:
+            messages.append(bytes((0xC0 | channel, state[StateProgram])))
+        for controller in range(120):
+            if state[controller] != Unset and controller not in BankSelects and controller not in ParameterControllers:
+                messages.append(bytes((0xB0 | channel, controller, state[controller])))
+        #the parameter selected last goes last, right before its data entry
+        selects = NRPNSelects + RPNSelects if state[StateSelected] == RPNSelects[0] else RPNSelects + NRPNSelects
+        for controller in selects + DataEntry:
+            if state[controller] != Unset:
+                messages.append(bytes((0xB0 | channel, controller, state[controller])))
+        if state[StatePressure] != Unset:
+            messages.append(bytes((0xD0 | channel, state[StatePressure])))
+        if state[StateBendLSB] != Unset:
+            messages.append(bytes((0xE0 | channel, state[StateBendLSB], state[StateBendMSB])))
+    return messages
+
+class aSeekIndex:
+    def __init__(self, mySong, interval=SnapshotInterval):
+        self.song = mySong
+        events = mySong.events
+        self.order = array.array('I') #rows of the event table, in merged time order
+        self.times = array.array('d') #time in seconds of each of them
+        self.snapshotTimes = array.array('d')
+        self.snapshotPositions = array.array('I') #position in order of the first event after the snapshot
+        self.snapshotStates = [] #16 channel states, back to back, as bytes
+        self.notes = None #midi_notes.aNoteIndex, built from order and times when first needed
+
+        states = [bytearray([Unset]) * StateSize for channel in range(16)]
+        self.takesnapshot(0., 0, states) #even a song with no channel event has one to seek to
+        nextSnapshot = interval
+        for absTick, trackNo, row, absTime in midi_parser.mergetracks(events, mySong.tempoMap):
+            while absTime >= nextSnapshot: #taken before any event at or after its time
+                self.takesnapshot(nextSnapshot, len(self.order), states)
+                nextSnapshot += interval
+            self.order.append(row)
+            self.times.append(absTime)
+            applystate(states, events.status[row], events.data1[row], events.data2[row])
+
+    def takesnapshot(self, snapshotTime, position, states):
+        self.snapshotTimes.append(snapshotTime)
+        self.snapshotPositions.append(position)
+        self.snapshotStates.append(b"".join(states))
+
+    def noteindex(self):
+        if self.notes is None:
+            self.notes = midi_notes.aNoteIndex(self.song.events, self.order, self.times)
+        return self.notes
+
+    def duration(self):
+        return self.times[-1] if len(self.times) > 0 else 0.
+
+    # channel states and position in order to resume from at the given time
+    def seek(self, seconds):
+        events = self.song.events
+        k = max(0, bisect.bisect_right(self.snapshotTimes, seconds) - 1)
+        snapshot = self.snapshotStates[k]
+        states = [bytearray(snapshot[(channel * StateSize):((channel + 1) * StateSize)]) for channel in range(16)]
+        position = self.snapshotPositions[k]
+        end = bisect.bisect_left(self.times, seconds, position)
+        for n in range(position, end): #the chase, at most one interval worth of events
+            row = self.order[n]
+            applystate(states, events.status[row], events.data1[row], events.data2[row])
+        return states, end
+
+    # (time in seconds, bytes to send) from start to end, shifted to begin at 0:
+    # the channel states first, then the song's events
+    def timeline(self, start=0., end=None, offset=0.):
+        events = self.song.events
+        states, position = self.seek(start)
+        for msgToSend in statemessages(states):
+            yield offset, msgToSend
+        stop = len(self.order) if end is None else bisect.bisect_left(self.times, end, position)
+        for n in range(position, stop):
+            yield offset + self.times[n] - start, events.message(self.order[n])
+
+    # plays a to b over and over: every pass starts from the states at a, with no
+    # note left hanging or controller left set from the pass before. The notes still on at b get their
+    # own note off, for synths that ignore all notes off. The clock never
+    # restarts, so there's no drift from one pass to the next
+    def looptimeline(self, a, b, loops):
+        noteOffs = self.noteindex().noteoffs(b, includeEnding=True) #the pass stops before the events at b
+        offset = 0.
+        for loop in range(loops):
+            yield from self.timeline(a, b, offset)
+            offset += b - a
+            for msgToSend in noteOffs:
+                yield offset, msgToSend
+        silence = [bytearray([Unset]) * StateSize for channel in range(16)]
+        for msgToSend in statemessages(silence):
+            yield offset, msgToSend
+
+def playfrom(mySong, start, end=None, loops=1, clockMode="deadline", spinThreshold=midi_parser.SpinThreshold):
+    index = aSeekIndex(mySong)
+    if end is None:
+        return midi_parser.playtimeline(index.timeline(start), clockMode, spinThreshold)
+    return midi_parser.playtimeline(index.looptimeline(start, end, loops), clockMode, spinThreshold)
+
+if __name__ == "__main__":
+    import midi_cache
+    import midi_sinks
+    midi_parser.setuplogging()
+    midi_parser.out = midi_sinks.opensink(sys.argv[1])
+    mySong = midi_cache.loadsong(sys.argv[2])
+    start = float(sys.argv[3])
+    end = float(sys.argv[4]) if len(sys.argv) > 4 else None
+    loops = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    playfrom(mySong, start, end, loops)
+    midi_parser.out.close()
@@ -0,0 +1,112 @@
+#
+#     midi_sinks.py
+#   Where the player's messages go. A sink is anything with send_message(bytes)
+#   and close(), like a rtmidi.MidiOut, so the player, midi_async and the other
+#   tools take any of these:
+#   - aRtmidiSink:    a hardware (or virtual) port through rtmidi
+#   - aNullSink:      takes everything, sends nothing
+#   - aRecordingSink: notes the time.perf_counter_ns() of every message, in
+#                     memory, and writes them to a file on close if given one.
+#                     It can pass everything on to another sink, timing how long
+#                     each send_message() of that sink took
+#   - aLoopbackSink:  an in-process cable: what's sent comes out of receive(),
+#                     timestamped, or goes to a callback like rtmidi.MidiIn's
+#   opensink() makes one from a short text, for command lines: a port number,
+#   "null", "loopback", "record" or "record=file"
+#
+
+import time
+import array
+import queue
+import logging
+
+log = logging.getLogger("midi_sinks")
+
+class aRtmidiSink:
+    def __init__(self, port):
+        import rtmidi #only needed when there's hardware to talk to
+        self.out = rtmidi.MidiOut()
+        log.info("ports: %s", self.out.get_ports())
+        log.info("port chosen: %d", port)
+        self.out.open_port(port)
+
+    def send_message(self, msgToSend):
+        self.out.send_message(msgToSend)
+
+    def close(self):
+        self.out.close_port()
+
+class aNullSink:
+    def send_message(self, msgToSend):
+        pass
+
+    def close(self):
+        pass
+
+class aRecordingSink:
+    def __init__(self, path=None, forward=None):
+        self.path = path
+        self.forward = forward #sink that really sends, if any
+        self.times = array.array('q')     #perf_counter_ns() of every message
+        self.sendTimes = array.array('q') #ns each forward.send_message() took
+        self.data = bytearray()           #every message, back to back
+        self.lengths = array.array('B')
+
+    def send_message(self, msgToSend):
+        nowNs = time.perf_counter_ns()
+        self.times.append(nowNs)
+        self.data += bytes(msgToSend)
+        self.lengths.append(len(msgToSend))
+        if self.forward is not None:
+            self.forward.send_message(msgToSend)
+            self.sendTimes.append(time.perf_counter_ns() - nowNs)
+
+    def __len__(self):
+        return len(self.times)
+
+    # (perf_counter_ns, bytes) of every message, in the order they came
+    def messages(self):
+        i = 0
+        for n in range(len(self.times)):
+            yield self.times[n], bytes(self.data[i:(i+self.lengths[n])])
+            i += self.lengths[n]
+
+    def close(self):
+        if self.path is not None:
+            with open(self.path, "w") as ff:
+                for nowNs, msgToSend in self.messages():
+                    ff.write("%d %s\n" % (nowNs, msgToSend.hex(" ")))
+        if self.forward is not None:
+            self.forward.close()
+
+class aLoopbackSink:
+    def __init__(self, callback=None):
+        self.callback = callback #called with (perf_counter_ns, bytes) instead of queueing
+        self.received = queue.SimpleQueue()
+
+    def send_message(self, msgToSend):
+        if self.callback is not None:
+            self.callback(time.perf_counter_ns(), bytes(msgToSend))
+        else:
+            self.received.put((time.perf_counter_ns(), bytes(msgToSend)))
+
+    # the next (perf_counter_ns, bytes) sent, None if nothing came in time
+    def receive(self, timeout=None):
+        try:
+            return self.received.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+def opensink(spec):
+    if spec == "null":
+        return aNullSink()
+    elif spec == "loopback":
+        return aLoopbackSink()
+    elif spec == "record":
+        return aRecordingSink()
+    elif spec.startswith("record="):
+        return aRecordingSink(spec[len("record="):])
+    return aRtmidiSink(int(spec))
@@ -0,0 +1,128 @@
+#
+#     midi_thin.py
+#   Cuts down the traffic sent to the MIDI port, for slow DIN hardware
+#   (31250 baud, about 320 us per byte) that lags behind dense controller sweeps.
+#   Sits between parsing and playback, on a timeline of (time, bytes to send):
+#   - messages that set a controller, channel pressure or pitch bend to the
+#     value it already has are dropped (program changes never are: sending the
+#     same program again is what applies a bank select). Reset All Controllers
+#     forgets what was sent on its channel
+#   - continuous streams (controllers, pitch bend, channel and polyphonic
+#     pressure) are thinned to at most `rate` messages per second for each
+#     channel/controller: in between, only the latest value is kept and it goes
+#     out when the interval is over, so a sweep always ends on its last value,
+#     or sooner when a note of that channel starts or ends.
+#     Switch controllers (sustain, portamento, sostenuto, soft pedal, legato,
+#     hold 2) and bank select are never held back
+#
+#     Usage (reports the savings on each file):
+#   python midi_thin.py <.mid filename> [<.mid filename> ...] [-r rate]
+#
+
+import heapq
+import argparse
+import midi_parser
+
+ThinRate = 100. #messages per second per channel/controller
+DinByteTime = 10 / 31250. #seconds to send a byte over a DIN cable, start and stop bits included
+UnthinnedControllers = (0, 32, 64, 65, 66, 67, 68, 69)
+
+# which continuous stream a message belongs to, None if it isn't one
+def thinkey(status, data1):
+    kind = status & 0xF0
+    if kind == 0xB0:
+        if data1 < 120 and data1 not in UnthinnedControllers and data1 not in midi_parser.NonStateControllers:
+            return (status, data1)
+    elif kind == 0xA0:
+        return (status, data1)
+    elif kind == 0xD0 or kind == 0xE0:
+        return (status,)
+    return None
+
+class aThinStats:
+    def __init__(self):
+        self.messagesIn = 0
+        self.messagesOut = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def report(self, name):
+        savedMessages = self.messagesIn - self.messagesOut
+        savedBytes = self.bytesIn - self.bytesOut
+        print("%s: %d -> %d messages (%d saved), %d -> %d bytes (%d saved, %.2f s of DIN time)" %
+              (name, self.messagesIn, self.messagesOut, savedMessages, self.bytesIn, self.bytesOut, savedBytes, savedBytes * DinByteTime))
+
+# timeline in, thinned timeline out, still in time order
+def thintimeline(timeline, rate=ThinRate, dropRepeats=True, stats=None):
+    interval = 1. / rate if rate > 0 else 0.
+    sentValues = {} #statekey -> last value sent, or held to be sent
+    lastSent = {}   #thinkey -> time the last message of that stream went out
+    held = {}       #thinkey -> (due time, bytes), latest value waiting for its turn
+    due = []        #heap of (due time, order, thinkey) for what's held
+    order = 0
+    if stats is None:
+        stats = aThinStats()
+
+    def send(absTime, msgToSend):
+        stats.messagesOut += 1
+        stats.bytesOut += len(msgToSend)
+        return absTime, msgToSend
+
+    for absTime, msgToSend in timeline:
+        stats.messagesIn += 1
+        stats.bytesIn += len(msgToSend)
+        while due and due[0][0] <= absTime: #held values whose turn came
+            dueTime, n, key = heapq.heappop(due)
+            if key in held and held[key][0] == dueTime:
+                lastSent[key] = dueTime
+                yield send(*held.pop(key))
+
+        status = msgToSend[0]
+        data1 = msgToSend[1] if len(msgToSend) > 1 else 0
+        data2 = msgToSend[2] if len(msgToSend) > 2 else 0
+        key = thinkey(status, data1) if interval > 0 else None
+        reset = (status & 0xF0) == 0xB0 and data1 == midi_parser.ResetAllControllers
+        if held and (reset or (status & 0xE0) == 0x80):
+            #what's held on that channel goes out before a note on/off, so the note
+            #starts or ends with the values set before it, and before a reset
+            for heldKey in [heldKey for heldKey in held if (heldKey[0] & 0x0F) == (status & 0x0F)]:
+                lastSent[heldKey] = absTime
+                yield send(absTime, held.pop(heldKey)[1])
+        if reset:
+            midi_parser.forgetchannel(sentValues, status)
+        stateKey, value = midi_parser.statekey(status, data1, data2)
+        if dropRepeats and stateKey is not None and sentValues.get(stateKey) == value:
+            continue
+        if key is not None and key in lastSent and absTime - lastSent[key] < interval:
+            dueTime = lastSent[key] + interval
+            if key not in held:
+                heapq.heappush(due, (dueTime, order, key))
+                order += 1
+            held[key] = (dueTime, msgToSend)
+            if stateKey is not None:
+                sentValues[stateKey] = value #it will be, once its turn comes
+            continue
+        held.pop(key, None)
+        if key is not None:
+            lastSent[key] = absTime
+        if stateKey is not None:
+            sentValues[stateKey] = value
+        yield send(absTime, msgToSend)
+
+    while due: #what's still held once the song is over
+        dueTime, n, key = heapq.heappop(due)
+        if key in held and held[key][0] == dueTime:
+            yield send(*held.pop(key))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report how much MIDI traffic thinning saves")
+    parser.add_argument("files", nargs="+", help=".mid files")
+    parser.add_argument("-r", "--rate", type=float, default=ThinRate, help="messages per second per channel/controller (default: %g)" % ThinRate)
+    parser.add_argument("--keep-repeats", action="store_true", help="don't drop messages that set what's already set")
+    args = parser.parse_args()
+    for file in args.files:
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(file))
+        stats = aThinStats()
+        for item in thintimeline(midi_parser.songtimeline(mySong), args.rate, not args.keep_repeats, stats):
+            pass
+        stats.report(file)
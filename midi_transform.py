@@ -0,0 +1,141 @@
+#
+#     midi_transform.py
+#   Changes a whole parsed song at once, without touching the file or parsing it
+#   again: transpose, velocity scaling, channel remapping and muting, tempo scaling.
+#   The event table is columns of bytes, so each change is a 256 entry lookup
+#   table built once, and every column goes through its tables in a single pass
+#   done by bytes.translate(), map() and itertools.compress(): no Python code
+#   runs per event. Tempo scaling only rebuilds the tempo map, the ticks stay.
+#   While playing, the speed can also be changed live (aTempoControl in
+#   midi_parser.py): type a multiplier and enter, e.g. 1.5 or 0.8
+#
+#     Usage:
+#   python midi_transform.py <portNum> <.mid filename> [-s semitones] [-v velocity scale]
+#                            [-m from:to ...] [--mute channel ...] [-t tempo scale]
+#
+#   channels are numbered 1 to 16, like on a synth
+#
+
+import sys
+import array
+import operator
+import argparse
+import itertools
+import threading
+import midi_parser
+
+DrumChannel = 9 #channel 10: its note numbers pick drums, they don't get transposed
+NoteKinds = (0x80, 0x90, 0xA0) #messages whose data1 is a note number
+MaxTempo = 0xFFFFFF #microseconds per beat have to fit the 3 bytes of MetaSetTempo
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+def identitytable():
+    return bytes(range(256))
+
+# new status byte for every status byte: channel messages moved to their new channel
+def statustable(channelMap):
+    table = bytearray(identitytable())
+    for status in range(0x80, 0xF0):
+        channel = status & 0x0F
+        table[status] = (status & 0xF0) | channelMap.get(channel, channel)
+    return bytes(table)
+
+# 1 for the status bytes of the channels kept, 0 for the muted ones
+def keeptable(mute):
+    table = bytearray([1]) * 256
+    for status in range(0x80, 0xF0):
+        if (status & 0x0F) in mute:
+            table[status] = 0
+    return bytes(table)
+
+# one lookup table per status byte for data1: note numbers moved by semitones
+def data1tables(semitones):
+    identity = identitytable()
+    transposed = bytes([clamp(note + semitones, 0, 127) for note in range(128)]) + identity[128:]
+    return [transposed if (status & 0xF0) in NoteKinds and (status & 0x0F) != DrumChannel else identity
+            for status in range(256)]
+
+# same for data2: note on velocities scaled, never down to 0, which would be a note off
+def data2tables(velocityScale):
+    identity = identitytable()
+    scaled = bytes([0] + [clamp(round(velocity * velocityScale), 1, 127) for velocity in range(1, 128)]) + identity[128:]
+    return [scaled if (status & 0xF0) == 0x90 else identity for status in range(256)]
+
+# every column through its tables: table[status of the row][value of the row]
+def lookup(tables, status, column):
+    return array.array('B', map(operator.getitem, map(tables.__getitem__, status), column))
+
+def scaletempo(tempoMap, tempoScale):
+    tempoChanges = [(tick, clamp(round(usPerBeat / tempoScale), 1, MaxTempo)) for tick, usPerBeat in tempoMap.tempoChanges]
+    if tempoMap.smpteTickLength == 0 and not any(tick == 0 for tick, usPerBeat in tempoChanges):
+        #the default tempo applies until the first change, it has to be scaled too
+        tempoChanges.insert(0, (0, round(midi_parser.DefaultTempo / tempoScale)))
+    return midi_parser.aTempoMap(tempoMap.ppq, tempoChanges, tempoMap.smpteTickLength / tempoScale)
+
+# a new aMIDISong, the one given is left as it is. channelMap and mute use the
+# channels of the file (0 to 15), semitones and velocities are clamped to 0-127.
+# tempoScale above 1 plays faster
+def transformsong(mySong, semitones=0, velocityScale=1., channelMap=None, mute=(), tempoScale=1.):
+    if tempoScale <= 0:
+        raise ValueError("tempo scale must be positive, not %g" % tempoScale)
+    events = mySong.events
+    transformed = midi_parser.aMIDIEventTable()
+    status = events.status.tobytes()
+    transformed.ticks = array.array('I', events.ticks)
+    transformed.tracks = array.array('H', events.tracks)
+    transformed.data1 = lookup(data1tables(semitones), status, events.data1) if semitones else array.array('B', events.data1)
+    transformed.data2 = lookup(data2tables(velocityScale), status, events.data2) if velocityScale != 1. else array.array('B', events.data2)
+    transformed.status = array.array('B', status.translate(statustable(channelMap))) if channelMap else array.array('B', status)
+    transformed.trackStarts = array.array('I', events.trackStarts)
+
+    keep = status.translate(keeptable(mute)) if mute else b""
+    if keep.count(0):
+        for name in ("ticks", "tracks", "status", "data1", "data2"):
+            column = getattr(transformed, name)
+            setattr(transformed, name, array.array(column.typecode, itertools.compress(column, keep)))
+        #each track starts after the rows kept in the tracks before it
+        kept = 0
+        for trackNo in range(len(events.trackStarts)):
+            start, end = events.trackrange(trackNo)
+            transformed.trackStarts[trackNo] = kept
+            kept += keep.count(1, start, end)
+
+    tempoMap = scaletempo(mySong.tempoMap, tempoScale) if tempoScale != 1. else mySong.tempoMap
+    return midi_parser.aMIDISong(transformed, tempoMap, mySong.formatType, mySong.ppq)
+
+# changes the speed of what's playing from what's typed in, until the input ends
+def readtempo(tempo):
+    for line in sys.stdin:
+        try:
+            tempo.set(float(line))
+            print("tempo x", tempo.multiplier())
+        except ValueError as e:
+            print(e)
+
+def channelpair(text):
+    source, target = text.split(":")
+    return int(source) - 1, int(target) - 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a .mid file transposed, remapped, muted or at another speed")
+    parser.add_argument("port", help="MIDI out port number, or a sink: null, record=<file>...")
+    parser.add_argument("file", help=".mid file")
+    parser.add_argument("-s", "--semitones", type=int, default=0, help="transpose by that many semitones")
+    parser.add_argument("-v", "--velocity", type=float, default=1., help="scale note on velocities")
+    parser.add_argument("-m", "--map", type=channelpair, nargs="*", default=[], help="play channel from on channel to, e.g. 1:2")
+    parser.add_argument("--mute", type=int, nargs="*", default=[], help="channels to leave out")
+    parser.add_argument("-t", "--tempo", type=float, default=1., help="tempo scale, above 1 is faster")
+    args = parser.parse_args()
+
+    import midi_cache
+    import midi_sinks
+    mySong = transformsong(midi_cache.loadsong(args.file), args.semitones, args.velocity, dict(args.map),
+                           [channel - 1 for channel in args.mute], args.tempo)
+    midi_parser.setuplogging()
+    midi_parser.out = midi_sinks.opensink(args.port)
+    tempo = midi_parser.aTempoControl()
+    threading.Thread(target=readtempo, args=(tempo,), daemon=True).start()
+    midi_parser.playback(mySong, tempo=tempo)
+    midi_parser.out.close()
@@ -0,0 +1,116 @@
+#
+#     midi_writer.py
+#   Writes a parsed song back out as a standard midi file, normalized:
+#   - every track merged into the single track of a type 0 file
+#   - running status: a status byte is only written when it changes, and note
+#     offs with a velocity of 0 are written as note ons so they can share it
+#   - deltas as the shortest variable length quantities
+#   - optionally, no-op events dropped: controller, channel pressure, pitch
+#     bend and tempo changes that set what was already set
+#   Only what parse() keeps is written: channel messages and tempo changes, so
+#   text and other meta events are always left out. Parsing the written file
+#   gives back the same event stream (minus the no-ops, if they were dropped)
+#
+#     Usage:
+#   python midi_writer.py <.mid filename> <output .mid filename> [--keep-noops]
+#
+
+import sys
+import time
+import midi_parser
+
+def writevlq(value):
+    vlq = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        vlq.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return vlq
+
+# SMPTE time division back from the length of a tick
+def smptedivision(tickLength):
+    for fps in (24, 25, 29, 30):
+        ticksPerFrame = round(1. / (tickLength * fps))
+        if 0 < ticksPerFrame < 256 and abs(1. / (fps * ticksPerFrame) - tickLength) < 1e-12:
+            return bytes((256 - fps, ticksPerFrame))
+    raise ValueError("no SMPTE time division gives a tick of %g s" % tickLength)
+
+# the merged stream of events to write: (tick, status, data1, data2), and tempo
+# changes as (tick, 0xFF, MetaSetTempo, microseconds per beat) before the events of their tick
+def mergedevents(mySong, dropNoops):
+    events = mySong.events
+    tempoChanges = mySong.tempoMap.tempoChanges
+    if dropNoops:
+        effective = {}
+        for tick, usPerBeat in tempoChanges: #the last change on a tick wins
+            effective[tick] = usPerBeat
+        tempoChanges = []
+        currentTempo = midi_parser.DefaultTempo
+        for tick, usPerBeat in effective.items():
+            if usPerBeat != currentTempo:
+                tempoChanges.append((tick, usPerBeat))
+                currentTempo = usPerBeat
+    tempos = [(tick, 0xFF, midi_parser.MetaSetTempo, usPerBeat) for tick, usPerBeat in tempoChanges]
+    channelState = {} #midi_parser.statekey() -> last value, for no-op detection
+    merged = []
+    t = 0
+    for absTick, trackNo, row, absTime in midi_parser.mergetracks(events, mySong.tempoMap):
+        while t < len(tempos) and tempos[t][0] <= absTick:
+            merged.append(tempos[t])
+            t+=1
+        status, data1, data2 = events.status[row], events.data1[row], events.data2[row]
+        if dropNoops:
+            if (status & 0xF0) == 0xB0 and data1 == midi_parser.ResetAllControllers:
+                midi_parser.forgetchannel(channelState, status)
+            key, value = midi_parser.statekey(status, data1, data2)
+            if key is not None:
+                if channelState.get(key) == value:
+                    continue
+                channelState[key] = value
+        merged.append((absTick, status, data1, data2))
+    merged += tempos[t:]
+    return merged
+
+def writesong(mySong, dropNoops=True):
+    track = bytearray()
+    lastTick = 0
+    runningStatus = 0
+    for absTick, status, data1, data2 in mergedevents(mySong, dropNoops):
+        track += writevlq(absTick - lastTick)
+        lastTick = absTick
+        if status == 0xFF:
+            track += bytes((0xFF, midi_parser.MetaSetTempo, 3)) + data2.to_bytes(3, "big")
+            runningStatus = 0 #meta events cancel running status
+            continue
+        if (status & 0xF0) == 0x80 and data2 == 0:
+            status = 0x90 | (status & 0x0F) #the parser turns it back into a note off
+        if status != runningStatus:
+            track.append(status)
+            runningStatus = status
+        track.append(data1)
+        if not (0xC0 <= status <= 0xDF):
+            track.append(data2)
+    track += bytes((0x00, 0xFF, midi_parser.MetaEndOfTrack, 0x00))
+
+    if mySong.tempoMap.smpteTickLength > 0:
+        division = smptedivision(mySong.tempoMap.smpteTickLength)
+    else:
+        division = mySong.ppq.to_bytes(2, "big")
+    header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + division
+    return header + b"MTrk" + len(track).to_bytes(4, "big") + bytes(track)
+
+if __name__ == "__main__":
+    dropNoops = "--keep-noops" not in sys.argv
+    files = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    startNs = time.perf_counter_ns()
+    buf = midi_parser.read_until_mthd(files[0])
+    mySong = midi_parser.parse(buf)
+    parseBefore = time.perf_counter_ns() - startNs
+    data = writesong(mySong, dropNoops)
+    with open(files[1], "wb") as ff:
+        ff.write(data)
+    startNs = time.perf_counter_ns()
+    written = midi_parser.parse(midi_parser.read_until_mthd(files[1]))
+    parseAfter = time.perf_counter_ns() - startNs
+    print(files[0], ": ", len(buf), " bytes, ", len(mySong.events), " events, loaded in ", parseBefore / 1e6, " ms")
+    print(files[1], ": ", len(data), " bytes, ", len(written.events), " events, loaded in ", parseAfter / 1e6, " ms")
@@ -0,0 +1,61 @@
+#
+#     test_midi_async.py
+#   Streams sharing an output go out in deadline order, not in the order their
+#   events were handed to the sender
+#
+#     Usage:
+#   python -m pytest test_midi_async.py    (or python -m unittest test_midi_async)
+#
+
+import asyncio
+import unittest
+import midi_sinks
+import midi_parser
+import midi_async
+
+class aSenderTest(unittest.TestCase):
+    def test_sharedoutputdeadlineorder(self):
+        #A's note off is handed over before B's note on, which is due sooner
+        out = midi_sinks.aRecordingSink()
+        engine = midi_async.aEngine()
+        streamA = engine.stream([(0., bytes((0x90, 60, 100))), (0.015, bytes((0x80, 60, 0)))], out)
+        streamB = engine.stream([(0.005, bytes((0x91, 64, 100)))], out)
+        statsA, statsB = asyncio.run(engine.playall([streamA, streamB]))
+        engine.close()
+        self.assertEqual([msgToSend[0] for nowNs, msgToSend in out.messages()], [0x90, 0x91, 0x80])
+        self.assertLess(statsB["max"], 10.) #ms, waiting behind A's note off made it 10 late at least
+
+class aStreamTest(unittest.TestCase):
+    # plays a note at 0 and one at 60 ms, calling control at 45 ms: the second
+    # one is already in the sender by then
+    def playcontrolled(self, control):
+        out = midi_sinks.aRecordingSink()
+        engine = midi_async.aEngine()
+        stream = engine.stream([(0., bytes((0x90, 60, 100))), (0.060, bytes((0x90, 62, 100)))], out)
+        async def main():
+            playing = asyncio.ensure_future(engine.playall([stream]))
+            await asyncio.sleep(0.045)
+            await control(stream)
+            return await playing
+        asyncio.run(main())
+        engine.close()
+        return [msgToSend for nowNs, msgToSend in out.messages()]
+
+    def test_stopinsidelookahead(self):
+        async def stop(stream):
+            stream.stop()
+        sent = self.playcontrolled(stop)
+        self.assertNotIn(bytes((0x90, 62, 100)), sent)
+        self.assertEqual(sent[-1], bytes((0xBF, midi_parser.AllNotesOff, 0)))
+
+    def test_pauseinsidelookahead(self):
+        async def pauseresume(stream):
+            stream.pause()
+            await asyncio.sleep(0.050)
+            stream.resume()
+        sent = self.playcontrolled(pauseresume)
+        self.assertEqual(sent[-1], bytes((0x90, 62, 100))) #after the silence, not before it
+        self.assertEqual(sent.count(bytes((0x90, 62, 100))), 1)
+
+if __name__ == "__main__":
+    unittest.main()
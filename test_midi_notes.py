@@ -0,0 +1,61 @@
+#
+#     test_midi_notes.py
+#   The interval tree against a brute force check over every note, at every
+#   time a note starts or ends and in between
+#
+#     Usage:
+#   python -m pytest test_midi_notes.py    (or python -m unittest test_midi_notes)
+#
+
+import os
+import unittest
+import midi_parser
+import midi_notes
+
+Here = os.path.dirname(os.path.abspath(__file__))
+Files = ("canyon.mid", "bwv784.mid", "07-Geoscape1.MID")
+
+def songindex(file):
+    return midi_notes.songnotes(midi_parser.parse(midi_parser.read_until_mthd(os.path.join(Here, file))))
+
+def bruteactive(index, seconds, includeEnding=False):
+    return sorted(noteId for noteId in range(len(index)) if index.starts[noteId] <= seconds and
+                  (index.ends[noteId] > seconds or (includeEnding and index.ends[noteId] == seconds)) and
+                  index.ends[noteId] > index.starts[noteId])
+
+def brutebetween(index, start, end):
+    return sorted(noteId for noteId in range(len(index)) if index.starts[noteId] < end and
+                  index.ends[noteId] > start and index.ends[noteId] > index.starts[noteId])
+
+# every time a note starts or ends, and halfway to the next one
+def probetimes(index):
+    times = sorted(set(index.starts) | set(index.ends))
+    return sorted(times + [(times[n] + times[n + 1]) / 2 for n in range(len(times) - 1)])
+
+class aNoteIndexTest(unittest.TestCase):
+    def test_activenotes(self):
+        for file in Files:
+            index = songindex(file)
+            for seconds in probetimes(index)[::17]:
+                for includeEnding in (False, True):
+                    self.assertEqual(sorted(index.activenotes(seconds, includeEnding)), bruteactive(index, seconds, includeEnding), (file, seconds))
+
+    def test_notesbetween(self):
+        for file in Files:
+            index = songindex(file)
+            times = probetimes(index)[::23]
+            for n in range(len(times) - 1):
+                start, end = times[n], times[n + 1]
+                self.assertEqual(sorted(index.notesbetween(start, end)), brutebetween(index, start, end), (file, start, end))
+
+    def test_zerolengthnote(self):
+        table = midi_parser.aMIDIEventTable()
+        table.starttrack()
+        for tick, status, data1 in ((0, 0x90, 60), (0, 0x80, 60), (10, 0x90, 62), (10, 0x80, 62), (20, 0x90, 64), (30, 0x80, 64)):
+            table.append(tick, 0, status, data1, 100)
+        index = midi_notes.songnotes(midi_parser.aMIDISong(table, midi_parser.aTempoMap(96, []), 0, 96))
+        self.assertEqual(index.notesbetween(0., 1.), [2])
+        self.assertEqual(index.activenotes(0.), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+#
+#     test_midi_parser.py
+#   A truncated or malformed file ends its tracks with a warning: parse() and
+#   the streaming player's timeline give what could be read, nothing past the
+#   end of a track gets read
+#
+#     Usage:
+#   python -m pytest test_midi_parser.py    (or python -m unittest test_midi_parser)
+#
+
+import os
+import unittest
+import midi_parser
+
+Here = os.path.dirname(os.path.abspath(__file__))
+
+def readfile(file):
+    with open(os.path.join(Here, file), "rb") as ff:
+        return ff.read()
+
+class aTruncatedTest(unittest.TestCase):
+    def test_cutinhalf(self):
+        buffer = readfile("canyon.mid")
+        whole = list(midi_parser.songtimeline(midi_parser.parse(buffer)))
+        half = buffer[:len(buffer) // 2]
+        with self.assertLogs("midi_parser", "WARNING"):
+            parsed = list(midi_parser.songtimeline(midi_parser.parse(half)))
+        with self.assertLogs("midi_parser", "WARNING"):
+            streamed = list(midi_parser.streamtimeline(half))
+        self.assertEqual(parsed, streamed)
+        self.assertTrue(0 < len(parsed) < len(whole))
+
+    def test_headercutshort(self):
+        with self.assertLogs("midi_parser", "ERROR"):
+            self.assertRaises(ValueError, midi_parser.parse, readfile("canyon.mid")[:10])
+
+    def test_eventstayswithinitstrack(self):
+        #a note on cut after its first data byte, right before the next chunk
+        track = bytes((0x00, 0x90, 60, 100, 0x10, 0x80, 60))
+        endOfTrack = bytes((0x00, 0xFF, 0x2F, 0x00))
+        buffer = (b"MThd" + (6).to_bytes(4) + (1).to_bytes(2) + (2).to_bytes(2) + (96).to_bytes(2) +
+                  b"MTrk" + len(track).to_bytes(4) + track +
+                  b"MTrk" + (len(endOfTrack) + 4).to_bytes(4) + bytes((0x00, 0x91, 64, 100)) + endOfTrack)
+        with self.assertLogs("midi_parser", "WARNING"):
+            mySong = midi_parser.parse(buffer)
+        self.assertEqual(list(midi_parser.songtimeline(mySong)), [(0., bytes((0x90, 60, 100))), (0., bytes((0x91, 64, 100)))])
+
+class aPlayerTest(unittest.TestCase):
+    def test_nosink(self):
+        mySong = midi_parser.parse(readfile("canyon.mid"))
+        self.assertIsNone(midi_parser.out)
+        self.assertRaises(ValueError, midi_parser.playback, mySong)
+
+if __name__ == "__main__":
+    unittest.main()
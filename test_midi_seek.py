@@ -0,0 +1,55 @@
+#
+#     test_midi_seek.py
+#   Seeking back leaves nothing set from later in the song, and Reset All
+#   Controllers in a song resets what RP-015 says and nothing more
+#
+#     Usage:
+#   python -m pytest test_midi_seek.py    (or python -m unittest test_midi_seek)
+#
+
+import os
+import unittest
+import midi_parser
+import midi_seek
+
+Here = os.path.dirname(os.path.abspath(__file__))
+
+class aSeekTest(unittest.TestCase):
+    def test_seekbackresetscontrollers(self):
+        #07-Geoscape1.MID holds the sustain pedal down on ch7 at 159 s
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(os.path.join(Here, "07-Geoscape1.MID")))
+        index = midi_seek.aSeekIndex(mySong)
+        states, position = index.seek(79.)
+        self.assertEqual(states[6][64], midi_seek.Unset)
+        messages = [msgToSend for absTime, msgToSend in index.timeline(79.) if absTime == 0. and msgToSend[0] == 0xB6]
+        self.assertEqual(messages[1], bytes((0xB6, midi_parser.ResetAllControllers, 0)))
+
+    def test_resetallcontrollers(self):
+        states = [bytearray([midi_seek.Unset]) * midi_seek.StateSize for channel in range(16)]
+        for status, data1, data2 in ((0xB0, 0, 1), (0xC0, 5, 0), (0xB0, 7, 100), (0xB0, 10, 30), (0xB0, 64, 127),
+                                     (0xB0, 1, 50), (0xE0, 0, 80), (0xD0, 40, 0), (0xB0, 121, 0)):
+            midi_seek.applystate(states, status, data1, data2)
+        state = states[0]
+        self.assertEqual((state[0], state[midi_seek.StateProgram], state[7], state[10]), (1, 5, 100, 30))
+        for n in (1, 64, midi_seek.StatePressure, midi_seek.StateBendLSB, midi_seek.StateBendMSB):
+            self.assertEqual(state[n], midi_seek.Unset)
+
+    def test_dataentryafterparameterselect(self):
+        #pitch bend range of 12 semitones (RPN 0), then a controller after it
+        states = [bytearray([midi_seek.Unset]) * midi_seek.StateSize for channel in range(16)]
+        for data1, data2 in ((101, 0), (100, 0), (6, 12), (38, 0), (96, 0), (7, 100)):
+            midi_seek.applystate(states, 0xB0, data1, data2)
+        messages = [msgToSend.hex() for msgToSend in midi_seek.statemessages(states)[:7]]
+        self.assertEqual(messages, ["b07b00", "b07900", "b00764", "b06500", "b06400", "b0060c", "b02600"])
+
+    def test_nochannelevents(self):
+        table = midi_parser.aMIDIEventTable()
+        table.starttrack()
+        mySong = midi_parser.aMIDISong(table, midi_parser.aTempoMap(96, [(0, 400000)]), 0, 96)
+        index = midi_seek.aSeekIndex(mySong)
+        states, position = index.seek(5.)
+        self.assertEqual(position, 0)
+        self.assertEqual(len(list(index.timeline(1.))), 32) #all notes off and reset, for every channel
+
+if __name__ == "__main__":
+    unittest.main()
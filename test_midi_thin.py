@@ -0,0 +1,49 @@
+#
+#     test_midi_thin.py
+#   What midi_thin.py drops as a repeat, and what it has to let through
+#
+#     Usage:
+#   python -m pytest test_midi_thin.py    (or python -m unittest test_midi_thin)
+#
+
+import os
+import unittest
+import midi_parser
+import midi_thin
+
+Here = os.path.dirname(os.path.abspath(__file__))
+
+def thinned(timeline, rate=0.):
+    return list(midi_thin.thintimeline(timeline, rate))
+
+class aThinTest(unittest.TestCase):
+    def test_repeats(self):
+        timeline = [(0., bytes((0xB0, 7, 100))), (1., bytes((0xB0, 7, 100))), (2., bytes((0xB0, 7, 90)))]
+        self.assertEqual(thinned(timeline), [timeline[0], timeline[2]])
+
+    def test_programchangeafterbankselect(self):
+        #Asayake.mid, ch3 at 38.644 s: b2 00 00 / b2 20 01 / c2 1b, same program as before
+        mySong = midi_parser.parse(midi_parser.read_until_mthd(os.path.join(Here, "Asayake.mid")))
+        timeline = list(midi_parser.songtimeline(mySong))
+        programs = [(absTime, msgToSend) for absTime, msgToSend in timeline if msgToSend[0] == 0xC2]
+        self.assertTrue(any(38.6 < absTime < 38.7 for absTime, msgToSend in programs))
+        kept = [item for item in thinned(timeline) if item[1][0] == 0xC2]
+        self.assertEqual(kept, programs)
+
+    def test_resetallcontrollers(self):
+        timeline = [(0., bytes((0xB0, 1, 64))), (1., bytes((0xB0, 121, 0))), (2., bytes((0xB0, 1, 64))),
+                    (3., bytes((0xE1, 0, 64))), (4., bytes((0xB0, 121, 0))), (5., bytes((0xE1, 0, 64)))]
+        self.assertEqual(thinned(timeline), timeline[:5])
+
+    def test_heldvaluegoesbeforereset(self):
+        #the sweep's last value is held back, it must not come out after the reset
+        timeline = [(0., bytes((0xB0, 1, 10))), (0.001, bytes((0xB0, 1, 20))), (0.002, bytes((0xB0, 121, 0)))]
+        self.assertEqual(thinned(timeline, 100.), [timeline[0], (0.002, timeline[1][1]), timeline[2]])
+
+    def test_heldvaluegoesbeforenote(self):
+        #the bend back to the center is held back, the note must not start bent
+        timeline = [(0., bytes((0xE0, 0x00, 0x50))), (0.004, bytes((0xE0, 0x00, 0x40))), (0.004, bytes((0x90, 0x3C, 0x64)))]
+        self.assertEqual(thinned(timeline, 100.), timeline)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#
+#     test_midi_writer.py
+#   Parsing a file written by midi_writer.py gives back the same event stream:
+#   exactly with the no-ops kept, minus the no-ops when they're dropped.
+#
+#     Usage:
+#   python -m pytest test_midi_writer.py    (or python -m unittest test_midi_writer)
+#
+
+import os
+import unittest
+import midi_parser
+import midi_writer
+
+Here = os.path.dirname(os.path.abspath(__file__))
+Files = ("canyon.mid", "Asayake.mid", "bwv784.mid", "07-Geoscape1.MID")
+
+def loadsong(file):
+    return midi_parser.parse(midi_parser.read_until_mthd(os.path.join(Here, file)))
+
+# (tick, status, data1, data2) of every event, in merged order
+def eventstream(mySong):
+    events = mySong.events
+    return [(absTick, events.status[row], events.data1[row], events.data2[row])
+            for absTick, trackNo, row, absTime in midi_parser.mergetracks(events, mySong.tempoMap)]
+
+def roundtrip(mySong, dropNoops):
+    return midi_parser.parse(midi_writer.writesong(mySong, dropNoops))
+
+# a one track song from (tick, status, data1, data2) events
+def makesong(events):
+    table = midi_parser.aMIDIEventTable()
+    table.starttrack()
+    for tick, status, data1, data2 in events:
+        table.append(tick, 0, status, data1, data2)
+    return midi_parser.aMIDISong(table, midi_parser.aTempoMap(96, []), 0, 96)
+
+class aRoundTripTest(unittest.TestCase):
+    def test_keepnoops(self):
+        for file in Files:
+            mySong = loadsong(file)
+            written = roundtrip(mySong, False)
+            self.assertEqual(eventstream(written), eventstream(mySong), file)
+            self.assertEqual(written.tempoMap.segmentTickLengths, mySong.tempoMap.segmentTickLengths, file)
+
+    def test_dropnoops(self):
+        for file in Files:
+            mySong = loadsong(file)
+            expected = [event for event in midi_writer.mergedevents(mySong, True) if event[1] != 0xFF]
+            written = roundtrip(mySong, True)
+            self.assertEqual(eventstream(written), expected, file)
+            self.assertLessEqual(len(written.events), len(mySong.events), file)
+
+    def test_programchangeafterbankselect(self):
+        #like Asayake.mid at 38.644 s: the same program again applies the new bank
+        events = [(0, 0xB2, 0, 0), (0, 0xB2, 32, 0), (0, 0xC2, 27, 0),
+                  (96, 0xB2, 0, 0), (96, 0xB2, 32, 1), (96, 0xC2, 27, 0)]
+        written = eventstream(roundtrip(makesong(events), True))
+        self.assertEqual(written.count((96, 0xC2, 27, 0)), 1)
+        self.assertNotIn((96, 0xB2, 0, 0), written) #that one is still a no-op
+
+    def test_resetallcontrollers(self):
+        #a value set again after a reset isn't a repeat
+        events = [(0, 0xB0, 1, 64), (10, 0xB0, 121, 0), (20, 0xB0, 1, 64), (30, 0xB1, 1, 64), (40, 0xB1, 1, 64)]
+        written = eventstream(roundtrip(makesong(events), True))
+        self.assertEqual(written, events[:4])
+
+if __name__ == "__main__":
+    unittest.main()